@@ -0,0 +1,252 @@
+"""Admission control shared by every function (each deploys its own identical copy of this file).
+
+Each request takes a token from two buckets: one for its user and action, one for the user overall.
+Requests that do database work also hold one of DB_CONCURRENCY leases while they run. A request that
+finds an empty bucket or no free lease is shed. It gets the last good response to the same read
+(if one is at most STALE_TTL old), or a 429 with Retry-After.
+
+With REDIS_URL the buckets and leases live in Redis and apply across all instances. Otherwise they
+are per process, which still bounds the single-process app server.
+"""
+import functools
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+REDIS_URL = os.environ.get("REDIS_URL")
+DB_CONCURRENCY = int(os.environ.get("ADMISSION_DB_CONCURRENCY", "20"))
+DB_WAIT = int(os.environ.get("ADMISSION_DB_WAIT_MS", "100")) / 1000
+# A crashed instance's lease is reclaimed after this long
+LEASE_TTL = 30
+STALE_TTL = int(os.environ.get("ADMISSION_STALE_TTL", "60"))
+CACHE_SIZE = 2000
+MAX_BUCKETS = 100000
+
+# (burst, tokens per second) for one user's calls of "function:action"
+RATES = {
+    "messages:history": (10, 1.0),
+    "messages:group_history": (10, 1.0),
+    "messages:list": (10, 1.0),
+    "messages:notifications": (5, 0.5),
+    "messages:heartbeat": (5, 0.5),
+    "messages:typing": (20, 2.0),
+    "messages:search_chat": (10, 2.0),
+    "posts:feed": (10, 1.0),
+    "posts:hashtag_suggest": (20, 5.0),
+    "search-users:search": (10, 3.0),
+    "auth:login": (5, 0.1),
+    "auth:register": (3, 0.02),
+}
+DEFAULT_RATE = (20, 5.0)
+# Everything one user does across actions
+USER_RATE = (60, 20.0)
+# Fields that identify the acting user in query strings and bodies
+USER_FIELDS = ("user_id", "sender_id", "follower_id", "creator_id")
+
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local state = {}
+for i = 1, #KEYS do
+  local cap, rate = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+  local t = tonumber(redis.call('HGET', KEYS[i], 't') or cap)
+  local ts = tonumber(redis.call('HGET', KEYS[i], 'ts') or now)
+  t = math.min(cap, t + math.max(0, now - ts) * rate)
+  if t < 1 then wait = math.max(wait, (1 - t) / rate) end
+  state[i] = t
+end
+for i = 1, #KEYS do
+  local cap, rate = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+  local t = state[i]
+  if wait == 0 then t = t - 1 end
+  redis.call('HSET', KEYS[i], 't', t, 'ts', now)
+  redis.call('EXPIRE', KEYS[i], math.ceil(cap / rate) + 1)
+end
+return tostring(wait)
+"""
+
+LEASE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+  return 1
+end
+return 0
+"""
+
+_limiter = None
+_limiter_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def log_metric(name, **fields):
+    print(json.dumps({"metric": name, **fields}))
+
+
+class LocalLimiter:
+    def __init__(self):
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(DB_CONCURRENCY)
+
+    def take(self, buckets):
+        """Takes a token from every (key, burst, rate) bucket, or from none; returns seconds to wait (0 = admitted)"""
+        now = time.monotonic()
+        with self.lock:
+            levels = []
+            wait = 0.0
+            for key, burst, rate in buckets:
+                tokens, ts = self.buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - ts) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append(tokens)
+            for (key, _, _), tokens in zip(buckets, levels):
+                self.buckets[key] = (tokens - 1 if not wait else tokens, now)
+                self.buckets.move_to_end(key)
+            # The least recently used buckets have had the longest to refill, so forgetting them costs least
+            while len(self.buckets) > MAX_BUCKETS:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def acquire(self):
+        return True if self.slots.acquire(timeout=DB_WAIT) else None
+
+    def release(self, lease):
+        self.slots.release()
+
+
+class RedisLimiter:
+    def __init__(self, client):
+        self.client = client
+        self.take_script = client.register_script(TAKE_SCRIPT)
+        self.lease_script = client.register_script(LEASE_SCRIPT)
+
+    def take(self, buckets):
+        args = [time.time()]
+        for _, burst, rate in buckets:
+            args += [burst, rate]
+        return float(self.take_script(keys=[f"admission:bucket:{key}" for key, _, _ in buckets], args=args))
+
+    def acquire(self):
+        lease = uuid.uuid4().hex
+        deadline = time.monotonic() + DB_WAIT
+        while True:
+            now = time.time()
+            if self.lease_script(keys=["admission:db"], args=[now, DB_CONCURRENCY, now + LEASE_TTL, lease]):
+                return lease
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.01)
+
+    def release(self, lease):
+        self.client.zrem("admission:db", lease)
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                if REDIS_URL:
+                    import redis
+                    _limiter = RedisLimiter(redis.Redis.from_url(REDIS_URL, socket_timeout=0.5))
+                else:
+                    _limiter = LocalLimiter()
+    return _limiter
+
+
+def describe(event, default_action):
+    """(action, acting user or client address, cache key) of a request"""
+    params = event.get("queryStringParameters") or {}
+    body = {}
+    if event.get("httpMethod", "GET") != "GET":
+        try:
+            body = json.loads(event.get("body") or "{}")
+        except ValueError:
+            body = {}
+    fields = body if isinstance(body, dict) and body else params
+    action = fields.get("action") or default_action
+    user = next((str(fields[f]) for f in USER_FIELDS if fields.get(f)), None)
+    if user is None:
+        user = "ip:" + ((event.get("requestContext") or {}).get("identity") or {}).get("sourceIp", "unknown")
+    return action, user, json.dumps([event.get("httpMethod"), params, fields], sort_keys=True, default=str)
+
+
+def cached(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry and time.monotonic() - entry[0] <= STALE_TTL:
+        return entry
+    return None
+
+
+def remember(key, resp):
+    with _cache_lock:
+        _cache[key] = (time.monotonic(), resp)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def shed(function, action, key, cors, read, retry_after, decision):
+    entry = cached(key) if read else None
+    if entry:
+        log_metric("admission", function=function, action=action, decision=decision, served="stale")
+        stored_at, resp = entry
+        age = int(time.monotonic() - stored_at)
+        return {**resp, "headers": {**resp.get("headers", {}), "X-Cache": "stale", "Age": str(age)}}
+    log_metric("admission", function=function, action=action, decision=decision, served="429")
+    exposed = ", ".join(filter(None, [cors.get("Access-Control-Expose-Headers"), "Retry-After"]))
+    return {
+        "statusCode": 429,
+        "headers": {**cors, "Access-Control-Expose-Headers": exposed,
+                    "Retry-After": str(max(1, math.ceil(retry_after)))},
+        "body": json.dumps({"error": "Слишком много запросов"}),
+    }
+
+
+def guard(function, cors, reads=(), db_free=(), default_action=None):
+    """Wraps handler(event, context) with rate limits, the DB lease and stale fallbacks for `reads`"""
+    def wrap(handler):
+        @functools.wraps(handler)
+        def guarded(event, context):
+            if event.get("httpMethod") == "OPTIONS":
+                return handler(event, context)
+            action, user, key = describe(event, default_action)
+            read = action in reads
+            name = f"{function}:{action}"
+            burst, rate = RATES.get(name, DEFAULT_RATE)
+            lease = None
+            try:
+                limiter = get_limiter()
+                wait = limiter.take([(f"{user}:{name}", burst, rate), (f"{user}:*", *USER_RATE)])
+                if wait:
+                    return shed(function, action, key, cors, read, wait, "rate_limited")
+                if action not in db_free:
+                    lease = limiter.acquire()
+                    if lease is None:
+                        return shed(function, action, key, cors, read, 1, "overloaded")
+            except Exception:
+                # Limits are best effort: an unreachable store must not take the API down with it
+                log_metric("admission", function=function, action=action, decision="unavailable")
+                limiter = None
+            try:
+                resp = handler(event, context)
+            finally:
+                if lease is not None:
+                    try:
+                        limiter.release(lease)
+                    except Exception:
+                        log_metric("admission", function=function, action=action, decision="release_failed")
+            if read and resp.get("statusCode") == 200:
+                remember(key, resp)
+            log_metric("admission", function=function, action=action, decision="admitted")
+            return resp
+        return guarded
+    return wrap
@@ -3,6 +3,7 @@ import os
 import hashlib
 import secrets
 import psycopg2
+import admission
 
 SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
 CORS = {
@@ -26,6 +27,7 @@ def generate_handle(name: str) -> str:
     return f"{base}{suffix}"
 
 
+@admission.guard("auth", CORS)
 def handler(event: dict, context) -> dict:
     """Регистрация и вход пользователей Eclipse"""
     if event.get("httpMethod") == "OPTIONS":
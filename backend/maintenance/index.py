@@ -0,0 +1,364 @@
+import json
+import os
+import io
+import gzip
+import re
+import time
+import psycopg2
+import datetime
+
+SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
+CORS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, X-Maintenance-Token",
+}
+PARTITIONED = ("chat_messages", "group_messages", "notifications")
+# table -> (archive kind, owner column); notifications are archived as one file per month
+MESSAGE_TABLES = {"chat_messages": ("chat", "chat_id"), "group_messages": ("group", "group_id")}
+MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", "3"))
+RETENTION_MONTHS = int(os.environ.get("ARCHIVE_RETENTION_MONTHS", "12"))
+# Client retries of a send are only deduplicated within this window
+SEND_KEY_TTL_DAYS = int(os.environ.get("SEND_KEY_TTL_DAYS", "7"))
+# Tombstones and unreferenced objects younger than this are left alone
+COMPACT_GRACE_HOURS = int(os.environ.get("COMPACT_GRACE_HOURS", "24"))
+COMPACT_BATCH = int(os.environ.get("COMPACT_BATCH", "500"))
+COMPACT_TIME_BUDGET = int(os.environ.get("COMPACT_TIME_BUDGET_S", "120"))
+# Compaction backs off while a replica lags more than this or the primary runs more queries than this
+COMPACT_MAX_LAG = float(os.environ.get("COMPACT_MAX_REPLICATION_LAG_S", "5"))
+COMPACT_MAX_ACTIVE = int(os.environ.get("COMPACT_MAX_ACTIVE_QUERIES", "20"))
+COMPACT_PAUSE = 0.1
+# Bucket prefix -> (table, column holding the object's CDN URL)
+MEDIA_PREFIXES = {"posts/": ("posts", "media_url"), "chat/": ("chat_messages", "file_url"),
+                  "group/": ("group_messages", "file_url")}
+
+
+def get_conn():
+    return psycopg2.connect(os.environ["DATABASE_URL"])
+
+
+def get_s3():
+    import boto3
+    return boto3.client(
+        "s3",
+        endpoint_url="https://bucket.poehali.dev",
+        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+    )
+
+
+def month_start(dt, months_back=0):
+    index = dt.year * 12 + dt.month - 1 - months_back
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def ensure_partitions(cur):
+    created = {}
+    for table in PARTITIONED:
+        cur.execute(f"SELECT {SCHEMA}.ensure_monthly_partitions(%s::regclass, %s)", (f"{SCHEMA}.{table}", MONTHS_AHEAD))
+        created[table] = cur.fetchone()[0]
+    return created
+
+
+def expired_partitions(cur, table):
+    """Partitions whose whole month is older than the retention window, oldest first"""
+    cutoff = month_start(datetime.datetime.now(datetime.timezone.utc), RETENTION_MONTHS)
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE n.nspname = %s AND p.relname = %s
+        ORDER BY c.relname
+    """, (SCHEMA, table))
+    parts = []
+    for (name,) in cur.fetchall():
+        m = re.search(r"_p(\d{4})_(\d{2})$", name)
+        if m:
+            period = datetime.date(int(m.group(1)), int(m.group(2)), 1)
+            if period < cutoff:
+                parts.append((name, period))
+    return parts
+
+
+def purge_send_keys(cur):
+    cur.execute(f"DELETE FROM {SCHEMA}.message_send_keys WHERE created_at < NOW() - make_interval(days => %s)",
+                (SEND_KEY_TTL_DAYS,))
+    return cur.rowcount
+
+
+class Pacer:
+    """Spaces compaction batches out, backs off under replication lag or load, and stops at the time budget"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.deadline = time.monotonic() + COMPACT_TIME_BUDGET
+        self.throttled = 0
+        self.exhausted = False
+
+    def pressure(self):
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT COALESCE((SELECT MAX(EXTRACT(EPOCH FROM replay_lag)) FROM pg_stat_replication), 0),
+                   (SELECT COUNT(*) FROM pg_stat_activity WHERE state = 'active' AND pid <> pg_backend_pid())
+        """)
+        lag, active = cur.fetchone()
+        cur.close()
+        self.conn.commit()
+        return float(lag), active
+
+    def proceed(self):
+        """Waits until the next batch may run; False once the budget is spent"""
+        delay = COMPACT_PAUSE
+        while time.monotonic() + delay < self.deadline:
+            time.sleep(delay)
+            lag, active = self.pressure()
+            if lag <= COMPACT_MAX_LAG and active <= COMPACT_MAX_ACTIVE:
+                return True
+            self.throttled += 1
+            delay = min(delay * 2, 10)
+        self.exhausted = True
+        return False
+
+
+def compact_posts(conn, pacer):
+    """Deletes posts tombstoned for longer than the grace period together with the rows pointing at them.
+
+    Returns the number of posts removed and the ids of hashtags they carried.
+    """
+    cur = conn.cursor()
+    removed, hashtag_ids = 0, set()
+    while pacer.proceed():
+        cur.execute(f"""
+            SELECT id FROM {SCHEMA}.posts
+            WHERE deleted_at < NOW() - make_interval(hours => %s)
+            ORDER BY deleted_at LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (COMPACT_GRACE_HOURS, COMPACT_BATCH))
+        ids = [r[0] for r in cur.fetchall()]
+        if not ids:
+            break
+        cur.execute(f"""
+            DELETE FROM {SCHEMA}.comment_likes
+            WHERE comment_id IN (SELECT id FROM {SCHEMA}.comments WHERE post_id = ANY(%s))
+        """, (ids,))
+        cur.execute(f"DELETE FROM {SCHEMA}.comments WHERE post_id = ANY(%s)", (ids,))
+        cur.execute(f"DELETE FROM {SCHEMA}.post_likes WHERE post_id = ANY(%s)", (ids,))
+        cur.execute(f"DELETE FROM {SCHEMA}.post_hashtags WHERE post_id = ANY(%s) RETURNING hashtag_id", (ids,))
+        hashtag_ids.update(r[0] for r in cur.fetchall())
+        cur.execute(f"DELETE FROM {SCHEMA}.notifications WHERE post_id = ANY(%s)", (ids,))
+        cur.execute(f"DELETE FROM {SCHEMA}.posts WHERE id = ANY(%s)", (ids,))
+        conn.commit()
+        removed += len(ids)
+        if len(ids) < COMPACT_BATCH:
+            break
+    cur.close()
+    return removed, hashtag_ids
+
+
+def recount_hashtags(conn, hashtag_ids):
+    """Resets counts to the number of live posts carrying each tag; delete only ever decremented them"""
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE {SCHEMA}.hashtags h SET count = n.live
+        FROM (
+            SELECT h2.id, COUNT(p.id) AS live
+            FROM {SCHEMA}.hashtags h2
+            LEFT JOIN {SCHEMA}.post_hashtags ph ON ph.hashtag_id = h2.id
+            LEFT JOIN {SCHEMA}.posts p ON p.id = ph.post_id AND p.deleted_at IS NULL
+            WHERE h2.id = ANY(%s)
+            GROUP BY h2.id
+        ) n
+        WHERE h.id = n.id AND h.count IS DISTINCT FROM n.live
+    """, (sorted(hashtag_ids),))
+    fixed = cur.rowcount
+    conn.commit()
+    cur.close()
+    return fixed
+
+
+def compact_messages(conn, pacer, table):
+    """Deletes message rows tombstoned for longer than the grace period"""
+    cur = conn.cursor()
+    removed = 0
+    while pacer.proceed():
+        cur.execute(f"""
+            DELETE FROM {SCHEMA}.{table} WHERE (id, created_at) IN (
+                SELECT id, created_at FROM {SCHEMA}.{table}
+                WHERE deleted_at < NOW() - make_interval(hours => %s)
+                ORDER BY deleted_at LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """, (COMPACT_GRACE_HOURS, COMPACT_BATCH))
+        batch = cur.rowcount
+        conn.commit()
+        removed += batch
+        if batch < COMPACT_BATCH:
+            break
+    cur.close()
+    return removed
+
+
+def reconcile_bucket(conn, s3, pacer):
+    """Deletes objects under the media prefixes that no live row points at, one listing page at a time.
+
+    Objects younger than the grace period may belong to a send or post still being committed. Chat and group
+    objects from before the archive cutoff are kept: their rows may exist only in an archive file.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    fresh = now - datetime.timedelta(hours=COMPACT_GRACE_HOURS)
+    cutoff = month_start(now, RETENTION_MONTHS)
+    archived = datetime.datetime(cutoff.year, cutoff.month, 1, tzinfo=datetime.timezone.utc)
+    paginator = s3.get_paginator("list_objects_v2")
+    cur = conn.cursor()
+    deleted = 0
+    for prefix, (table, column) in MEDIA_PREFIXES.items():
+        for page in paginator.paginate(Bucket="files", Prefix=prefix):
+            if not pacer.proceed():
+                cur.close()
+                return deleted
+            keys = [o["Key"] for o in page.get("Contents", [])
+                    if o["LastModified"] < fresh and (table == "posts" or o["LastModified"] >= archived)]
+            if not keys:
+                continue
+            cur.execute(f"""
+                SELECT split_part({column}, '/bucket/', 2) FROM {SCHEMA}.{table}
+                WHERE {column} IS NOT NULL AND split_part({column}, '/bucket/', 2) = ANY(%s) AND deleted_at IS NULL
+            """, (keys,))
+            live = {r[0] for r in cur.fetchall()}
+            conn.commit()
+            orphans = [k for k in keys if k not in live]
+            if orphans:
+                s3.delete_objects(Bucket="files", Delete={"Objects": [{"Key": k} for k in orphans], "Quiet": True})
+                deleted += len(orphans)
+    cur.close()
+    return deleted
+
+
+def compact(conn, s3):
+    pacer = Pacer(conn)
+    posts, hashtag_ids = compact_posts(conn, pacer)
+    result = {"posts": posts, "hashtags_recounted": recount_hashtags(conn, hashtag_ids) if hashtag_ids else 0}
+    for table in MESSAGE_TABLES:
+        result[table] = compact_messages(conn, pacer, table)
+    result["objects_deleted"] = reconcile_bucket(conn, s3, pacer)
+    result["throttled"] = pacer.throttled
+    result["complete"] = not pacer.exhausted
+    return result
+
+
+def row_json(columns, row):
+    doc = dict(zip(columns, row))
+    doc["created_at"] = doc["created_at"].isoformat()
+    return json.dumps(doc, ensure_ascii=False)
+
+
+def upload_jsonl(s3, key, lines):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+        for line in lines:
+            gz.write(line.encode() + b"\n")
+    s3.put_object(Bucket="files", Key=key, Body=buf.getvalue(), ContentType="application/gzip")
+
+
+def archive_partition(conn, s3, table, part, period):
+    """Copies one monthly partition to the bucket, records it in the manifest, then detaches and drops it"""
+    label = period.strftime("%Y_%m")
+    if table in MESSAGE_TABLES:
+        kind, owner_col = MESSAGE_TABLES[table]
+        columns = ["id", owner_col, "sender_id", "text", "msg_type", "file_url", "file_name", "duration", "created_at"]
+    else:
+        kind, owner_col = None, None
+        columns = ["id", "user_id", "from_user_id", "type", "post_id", "message", "is_read", "created_at"]
+
+    read = conn.cursor(name=f"archive_{part}")
+    read.itersize = 5000
+    order = f"{owner_col}, created_at, id" if owner_col else "created_at, id"
+    # Tombstoned messages not yet compacted are dropped rather than archived
+    live = "WHERE deleted_at IS NULL" if owner_col else ""
+    read.execute(f"SELECT {', '.join(columns)} FROM {SCHEMA}.{part} {live} ORDER BY {order}")
+    cur = conn.cursor()
+    total = 0
+
+    if owner_col:
+        owner, lines = None, []
+
+        def flush():
+            key = f"archive/{table}/{label}/{owner}.jsonl.gz"
+            upload_jsonl(s3, key, lines)
+            cur.execute(f"""
+                INSERT INTO {SCHEMA}.message_archives (kind, owner_id, period, s3_key, row_count)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (kind, owner_id, period) DO UPDATE SET s3_key=EXCLUDED.s3_key, row_count=EXCLUDED.row_count
+            """, (kind, owner, period, key, len(lines)))
+
+        for row in read:
+            if row[1] != owner and lines:
+                flush()
+                lines = []
+            owner = row[1]
+            lines.append(row_json(columns, row))
+            total += 1
+        if lines:
+            flush()
+    else:
+        lines = [row_json(columns, row) for row in read]
+        total = len(lines)
+        if lines:
+            upload_jsonl(s3, f"archive/{table}/{label}.jsonl.gz", lines)
+
+    read.close()
+    cur.execute(f"ALTER TABLE {SCHEMA}.{table} DETACH PARTITION {SCHEMA}.{part}")
+    cur.execute(f"DROP TABLE {SCHEMA}.{part}")
+    conn.commit()
+    cur.close()
+    return total
+
+
+def handler(event: dict, context) -> dict:
+    """Обслуживание БД Eclipse: создание партиций, очистка ключей отправки и удалённого контента, архивирование старых сообщений в S3"""
+    if event.get("httpMethod") == "OPTIONS":
+        return {"statusCode": 200, "headers": CORS, "body": ""}
+
+    token = os.environ.get("MAINTENANCE_TOKEN")
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    # Without a configured token nobody is let in: these actions drop partitions and delete bucket objects
+    if not token or headers.get("x-maintenance-token") != token:
+        return {"statusCode": 403, "headers": CORS, "body": json.dumps({"error": "Нет доступа"})}
+
+    body = json.loads(event.get("body") or "{}")
+    params = event.get("queryStringParameters") or {}
+    action = body.get("action") or params.get("action") or "all"
+
+    conn = get_conn()
+    cur = conn.cursor()
+
+    try:
+        result = {}
+        if action in ("partitions", "all"):
+            result["created"] = ensure_partitions(cur)
+            conn.commit()
+
+        if action in ("send_keys", "all"):
+            result["send_keys_purged"] = purge_send_keys(cur)
+            conn.commit()
+
+        if action in ("compact", "all"):
+            result["compacted"] = compact(conn, get_s3())
+
+        if action in ("archive", "all"):
+            s3 = get_s3()
+            archived = []
+            for table in PARTITIONED:
+                for part, period in expired_partitions(cur, table):
+                    rows = archive_partition(conn, s3, table, part, period)
+                    archived.append({"table": table, "partition": part, "rows": rows})
+            result["archived"] = archived
+
+        if not result:
+            return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Неизвестное действие"})}
+        return {"statusCode": 200, "headers": CORS, "body": json.dumps(result)}
+
+    finally:
+        cur.close()
+        conn.close()
@@ -0,0 +1,83 @@
+"""Presence load test: python bench_presence.py [users] [rounds] [threads]
+
+Every user heartbeats once per round through handler(), as clients do every ~25 seconds, while
+list-sized lookups (50 partners + 60 chats) run alongside. Uses Redis when REDIS_URL is set,
+otherwise the local store. DATABASE_URL is pointed nowhere to prove no request reaches Postgres.
+"""
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load():
+    sys.path.insert(0, HERE)
+    try:
+        spec = importlib.util.spec_from_file_location("bench_messages", os.path.join(HERE, "index.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(HERE)
+    return module
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+    os.environ["DATABASE_URL"] = "host=/nonexistent dbname=unused connect_timeout=1"
+    module = load()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def heartbeat(user_id):
+        event = {"httpMethod": "POST", "body": json.dumps({"action": "heartbeat", "user_id": user_id})}
+        started = time.perf_counter()
+        resp = module.handler(event, None)
+        assert resp["statusCode"] == 200, resp
+        return (time.perf_counter() - started) * 1e6
+
+    def typing(user_id):
+        event = {"httpMethod": "POST", "body": json.dumps({"action": "typing", "user_id": user_id,
+                                                           "chat_id": user_id % 5000})}
+        module.handler(event, None)
+
+    rng = random.Random(1)
+    lookups = [([rng.randrange(1, users + 1) for _ in range(50)],
+                [f"chat:{rng.randrange(5000)}" for _ in range(60)]) for _ in range(2000)]
+
+    def lookup(args):
+        started = time.perf_counter()
+        module.presence_lookup(*args)
+        return (time.perf_counter() - started) * 1e6
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(typing, range(1, users + 1, 20)))
+        for r in range(rounds):
+            ids = list(range(1, users + 1))
+            rng.shuffle(ids)
+            started = time.perf_counter()
+            beats = pool.map(heartbeat, ids)
+            reads = pool.map(lookup, lookups)
+            beat_us, read_us = sorted(beats), sorted(reads)
+            wall = time.perf_counter() - started
+            print(f"round {r + 1}: heartbeats={len(ids)} in {wall:.2f}s ({len(ids) / wall:,.0f}/s) "
+                  f"p50={percentile(beat_us, 0.5):.0f}us p99={percentile(beat_us, 0.99):.0f}us | "
+                  f"lookups p50={percentile(read_us, 0.5):.0f}us p99={percentile(read_us, 0.99):.0f}us")
+
+    store = type(module.presence.get_store()).__name__
+    growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+    print(f"store={store} users={users} peak_rss_growth={growth:.0f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Round trips and latency per read action, optionally against a baseline copy of this function:
+
+    git show <rev>:backend/messages/index.py > /tmp/baseline_index.py
+    DATABASE_URL=... python bench_queries.py --baseline /tmp/baseline_index.py --user 1 --chat 1
+
+"session" reuses one connection for every request, as the app server's pool does, so prepared
+statements are planned once; "fresh" opens a connection per request (connect time not counted).
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import psycopg2
+import psycopg2.extensions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Every execute is one round trip: psycopg2 sends the whole statement string at once"""
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.round_trips += 1
+        return super().execute(query, vars)
+
+
+def load(path, name):
+    sys.path.insert(0, HERE)
+    try:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(HERE)
+    return module
+
+
+def connect():
+    return psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=CountingCursor)
+
+
+def measure(module, params, runs, mode):
+    event = {"httpMethod": "GET", "queryStringParameters": params}
+    conn = connect() if mode == "session" else None
+    timings, trips = [], []
+    try:
+        for _ in range(runs + 1):
+            c = conn or connect()
+            CountingCursor.round_trips = 0
+            started = time.perf_counter()
+            resp = module.route(event, c)
+            elapsed = (time.perf_counter() - started) * 1000
+            if c is not conn:
+                c.close()
+            if resp["statusCode"] != 200:
+                raise RuntimeError(f"{params}: {resp['body']}")
+            timings.append(elapsed)
+            trips.append(CountingCursor.round_trips)
+    finally:
+        if conn:
+            conn.close()
+    # The first run warms caches (and prepares statements in session mode)
+    timings = sorted(timings[1:])
+    return {
+        "round_trips": max(trips[1:]),
+        "p50_ms": round(timings[len(timings) // 2], 2),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", help="index.py of the version to compare against")
+    parser.add_argument("--user", type=int, default=1)
+    parser.add_argument("--target", type=int, default=2)
+    parser.add_argument("--chat", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    actions = {
+        "list": {"action": "list", "user_id": args.user},
+        "notifications": {"action": "notifications", "user_id": args.user},
+        "counts": {"action": "counts", "user_id": args.user, "target_id": args.target},
+        "history": {"action": "history", "user_id": args.user, "chat_id": args.chat, "limit": 50},
+    }
+    versions = {"current": load(os.path.join(HERE, "index.py"), "bench_current")}
+    if args.baseline:
+        versions["baseline"] = load(args.baseline, "bench_baseline")
+
+    results = []
+    for action, params in actions.items():
+        params = {k: str(v) for k, v in params.items()}
+        for mode in ("fresh", "session"):
+            for label, module in versions.items():
+                row = {"action": action, "mode": mode, "version": label, **measure(module, params, args.runs, mode)}
+                results.append(row)
+                print(json.dumps(row))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Send throughput under concurrent client retries:
+
+    DATABASE_URL=... python bench_send.py --chat 1 --sender 1 --threads 16 --messages 2000 --retries 3
+
+Every message is sent `retries` times with the same client_msg_id from different threads at once,
+the way a flaky mobile connection resends. Afterwards exactly one row must exist per message.
+Each attempt calls route() on its own connection, as handler() does, but skips the admission guard:
+one sender's burst limit would otherwise shed nearly all of them.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load():
+    sys.path.insert(0, HERE)
+    try:
+        spec = importlib.util.spec_from_file_location("bench_messages", os.path.join(HERE, "index.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(HERE)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chat", type=int, default=1)
+    parser.add_argument("--sender", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--retries", type=int, default=3)
+    args = parser.parse_args()
+
+    module = load()
+    run = uuid.uuid4().hex[:8]
+    ids = {}
+    lock = threading.Lock()
+    timings = []
+    rejected = []
+
+    def send(i):
+        event = {"httpMethod": "POST", "body": json.dumps({
+            "action": "send", "chat_id": args.chat, "sender_id": args.sender,
+            "text": f"bench {run} {i}", "client_msg_id": f"{run}-{i}",
+        })}
+        conn = module.get_conn()
+        try:
+            started = time.perf_counter()
+            resp = module.route(event, conn)
+            elapsed = (time.perf_counter() - started) * 1000
+        finally:
+            conn.close()
+        body = json.loads(resp["body"])
+        with lock:
+            timings.append(elapsed)
+            if resp["statusCode"] != 200:
+                rejected.append(resp["statusCode"])
+                return
+            ids.setdefault(i, set()).add(body["id"])
+
+    attempts = [i for i in range(args.messages) for _ in range(args.retries)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(send, attempts))
+    wall = time.perf_counter() - started
+
+    conn = module.get_conn()
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM {module.SCHEMA}.chat_messages WHERE chat_id=%s AND text LIKE %s",
+                (args.chat, f"bench {run} %"))
+    rows = cur.fetchone()[0]
+    conn.close()
+
+    timings.sort()
+    diverged = sum(1 for v in ids.values() if len(v) != 1)
+    print(json.dumps({
+        "attempts": len(attempts),
+        "messages": args.messages,
+        "rows_written": rows,
+        "diverged_ids": diverged,
+        "non_200": len(rejected),
+        "attempts_per_s": round(len(attempts) / wall, 1),
+        "p50_ms": round(timings[len(timings) // 2], 2),
+        "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 2),
+    }))
+    if rows != args.messages or diverged or rejected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
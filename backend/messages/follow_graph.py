@@ -0,0 +1,145 @@
+import bisect
+import os
+import time
+from array import array
+from collections import Counter
+
+TTL = int(os.environ.get("FOLLOW_GRAPH_TTL", "300"))
+# Local edits kept on top of the CSR arrays before a full reload is forced
+MAX_OVERLAY = 10000
+# Cap on how many of a followed user's own follows are scanned for suggestions
+FANOUT = 500
+
+_graph = None
+
+
+def build_csr(keys, values, size):
+    """Counting sort of (key, value) pairs into offsets/targets arrays indexed by key"""
+    offsets = array("q", bytes(8 * (size + 2)))
+    for k in keys:
+        offsets[k + 1] += 1
+    for i in range(1, size + 2):
+        offsets[i] += offsets[i - 1]
+    targets = array("i", bytes(4 * len(keys)))
+    pos = array("q", offsets)
+    for k, v in zip(keys, values):
+        targets[pos[k]] = v
+        pos[k] += 1
+    return offsets, targets
+
+
+def mark(out_index, in_index, follower_id, following_id, present):
+    """Adds the edge to, or drops it from, an overlay indexed from both ends"""
+    if present:
+        out_index.setdefault(follower_id, set()).add(following_id)
+        in_index.setdefault(following_id, set()).add(follower_id)
+    else:
+        out_index.get(follower_id, set()).discard(following_id)
+        in_index.get(following_id, set()).discard(follower_id)
+
+
+class FollowGraph:
+    """Follows as two CSR adjacencies (out: who a user follows, in: who follows them) indexed by user id"""
+
+    def __init__(self, followers, followings, max_id):
+        # Edges arrive sorted by (follower, following) and the counting sort is stable,
+        # so every adjacency slice in both directions ends up sorted
+        self.size = max_id
+        self.out_offsets, self.out_targets = build_csr(followers, followings, max_id)
+        self.in_offsets, self.in_targets = build_csr(followings, followers, max_id)
+        # Overlay of edits since the load, indexed from both ends: user id -> set of other user ids
+        self.added_out, self.added_in = {}, {}
+        self.removed_out, self.removed_in = {}, {}
+        self.edits = 0
+        self.loaded_at = time.monotonic()
+
+    def stale(self):
+        return time.monotonic() - self.loaded_at > TTL or self.edits > MAX_OVERLAY
+
+    def _slice(self, offsets, targets, user_id):
+        if user_id < 0 or user_id > self.size:
+            return targets[0:0]
+        return targets[offsets[user_id]:offsets[user_id + 1]]
+
+    def _in_csr(self, follower_id, following_id):
+        if follower_id < 0 or follower_id > self.size:
+            return False
+        lo, hi = self.out_offsets[follower_id], self.out_offsets[follower_id + 1]
+        i = bisect.bisect_left(self.out_targets, following_id, lo, hi)
+        return i < hi and self.out_targets[i] == following_id
+
+    def is_following(self, follower_id, following_id):
+        if following_id in self.added_out.get(follower_id, ()):
+            return True
+        if following_id in self.removed_out.get(follower_id, ()):
+            return False
+        return self._in_csr(follower_id, following_id)
+
+    def following(self, user_id):
+        ids = self._slice(self.out_offsets, self.out_targets, user_id)
+        removed = self.removed_out.get(user_id)
+        if removed:
+            ids = [v for v in ids if v not in removed]
+        return list(ids) + sorted(self.added_out.get(user_id, ()))
+
+    def followers(self, user_id):
+        ids = self._slice(self.in_offsets, self.in_targets, user_id)
+        removed = self.removed_in.get(user_id)
+        if removed:
+            ids = [v for v in ids if v not in removed]
+        return list(ids) + sorted(self.added_in.get(user_id, ()))
+
+    def suggestions(self, user_id, limit=10):
+        """Friends of friends ranked by how many of the user's connections lead to them"""
+        mine = set(self.following(user_id))
+        scores = Counter()
+        for v in mine:
+            for w in self.following(v)[:FANOUT]:
+                scores[w] += 1
+        # People who already follow the user are strong candidates too
+        for v in self.followers(user_id):
+            scores[v] += 1
+        scores.pop(user_id, None)
+        for v in mine:
+            scores.pop(v, None)
+        return scores.most_common(limit)
+
+    def record(self, follower_id, following_id, followed):
+        """Applies a follow or unfollow; the overlay only ever holds edges that differ from the CSR"""
+        if followed == self.is_following(follower_id, following_id):
+            return
+        self.edits += 1
+        if self._in_csr(follower_id, following_id):
+            mark(self.removed_out, self.removed_in, follower_id, following_id, not followed)
+        else:
+            mark(self.added_out, self.added_in, follower_id, following_id, followed)
+
+
+def load(cur, schema):
+    cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {schema}.users")
+    max_id = int(cur.fetchone()[0])
+    followers, followings = array("i"), array("i")
+    cur.execute(f"SELECT follower_id, following_id FROM {schema}.follows ORDER BY follower_id, following_id")
+    while True:
+        rows = cur.fetchmany(10000)
+        if not rows:
+            break
+        for a, b in rows:
+            followers.append(a)
+            followings.append(b)
+    # Users may have been created between the two queries
+    max_id = max(max_id, max(followers, default=0), max(followings, default=0))
+    return FollowGraph(followers, followings, max_id)
+
+
+def get_graph(cur, schema):
+    """Process-wide graph, reloaded from the follows table once stale"""
+    global _graph
+    if _graph is None or _graph.stale():
+        _graph = load(cur, schema)
+    return _graph
+
+
+def record(follower_id, following_id, followed):
+    if _graph is not None:
+        _graph.record(follower_id, following_id, followed)
@@ -1,23 +1,56 @@
 import json
 import os
 import base64
-import boto3
+import gzip
 import psycopg2
+import re
+import uuid
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+import follow_graph
+import prepared
+import presence
+import admission
+import db_routing
 
 SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MESSAGE_COLUMNS = "id, sender_id, text, msg_type, file_url, file_name, duration, created_at"
+# Client message ids also name the uploaded file, so they are kept to URL-safe characters
+CLIENT_MSG_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Newest matches per message table that search ranks; older ones need a narrower query
+SEARCH_MATCHES = 1000
+HEADLINE_OPTIONS = "MaxFragments=1, MaxWords=18, MinWords=6, StartSel=«, StopSel=»"
+FUNCTION = "messages"
+# Read-only GET actions: may be served by a replica and combined into one batch request
+READ_ACTIONS = {"list", "notifications", "following", "followers", "suggestions", "counts", "liked_posts",
+                "search_chat", "context"}
+# Served from the presence store without opening a database connection
+PRESENCE_ACTIONS = {"heartbeat", "typing", "presence"}
 CORS = {
     "Access-Control-Allow-Origin": "*",
     "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Allow-Headers": "Content-Type, X-Session-Lsn",
+    "Access-Control-Expose-Headers": "X-Session-Lsn",
 }
+# Bucket uploads run here while the handler inserts the row that points at them
+_uploads = ThreadPoolExecutor(max_workers=4)
 
 
 def get_conn():
     return psycopg2.connect(os.environ["DATABASE_URL"])
 
 
+routing = db_routing.Routing(FUNCTION, READ_ACTIONS, "list", CORS, lambda: get_conn())
+log_metric = routing.log_metric
+# A module attribute so the app server can route a batch's reads to its shared connection instead
+get_read_conn = routing.get_read_conn
+
+
 def get_s3():
+    # boto3 dominates cold start, so it is only imported by actions that touch the bucket
+    import boto3
     return boto3.client(
         "s3",
         endpoint_url="https://bucket.poehali.dev",
@@ -26,6 +59,11 @@ def get_s3():
     )
 
 
+def start_upload(key, raw, content_type):
+    s3 = get_s3()
+    return _uploads.submit(s3.put_object, Bucket="files", Key=key, Body=raw, ContentType=content_type)
+
+
 def time_ago(dt):
     now = datetime.datetime.now(datetime.timezone.utc)
     diff = now - dt
@@ -39,13 +77,413 @@ def time_ago(dt):
     return f"{s // 86400} дн назад"
 
 
+def mark_chat_read(cur, chat_id, user_id):
+    # Moves the read watermark up to the latest message; never moves it back
+    prepared.execute(cur, "mark_chat_read", f"""
+        INSERT INTO {SCHEMA}.chat_read_marks AS r (chat_id, user_id, last_read_message_id)
+        SELECT $1, $2, COALESCE(MAX(id), 0) FROM {SCHEMA}.chat_messages WHERE chat_id=$1
+        ON CONFLICT (chat_id, user_id) DO UPDATE
+        SET last_read_message_id = EXCLUDED.last_read_message_id
+        WHERE r.last_read_message_id < EXCLUDED.last_read_message_id
+    """, (chat_id, user_id))
+
+
+def mark_group_read(cur, group_id, user_id):
+    prepared.execute(cur, "mark_group_read", f"""
+        INSERT INTO {SCHEMA}.group_read_marks AS r (group_id, user_id, last_read_message_id)
+        SELECT $1, $2, COALESCE(MAX(id), 0) FROM {SCHEMA}.group_messages WHERE group_id=$1
+        ON CONFLICT (group_id, user_id) DO UPDATE
+        SET last_read_message_id = EXCLUDED.last_read_message_id
+        WHERE r.last_read_message_id < EXCLUDED.last_read_message_id
+    """, (group_id, user_id))
+
+
+def send_message(cur, kind, owner_id, sender_id, client_msg_id, text, msg_type, file_url, file_name, duration):
+    """Writes the message, its send key, the chat summary and (for direct chats) the recipient's
+    notification in one statement. Returns (id, created_at), or None if client_msg_id was already sent."""
+    if kind == "chat":
+        table, key_col, chats, summary = "chat_messages", "chat_id", "chats", "user1_id, user2_id"
+        notify = f""", notified AS (
+            INSERT INTO {SCHEMA}.notifications (user_id, from_user_id, type, message)
+            SELECT CASE WHEN user1_id = $2 THEN user2_id ELSE user1_id END, $2, 'message', $9 FROM summary
+        )"""
+        preview = text[:100] if text else "Медиа сообщение"
+        args = (owner_id, sender_id, client_msg_id, text, msg_type, file_url, file_name, duration, preview)
+    else:
+        table, key_col, chats, summary, notify = "group_messages", "group_id", "group_chats", "group_chats.id", ""
+        args = (owner_id, sender_id, client_msg_id, text, msg_type, file_url, file_name, duration)
+    # The id is drawn while claiming the key, so a duplicate inserts nothing at all
+    prepared.execute(cur, f"send_{kind}", f"""
+        WITH send_key AS (
+            INSERT INTO {SCHEMA}.message_send_keys (sender_id, kind, client_msg_id, message_id)
+            VALUES ($2, '{kind}', $3, nextval('{SCHEMA}.{table}_id_seq'))
+            ON CONFLICT DO NOTHING
+            RETURNING message_id, created_at
+        ), msg AS (
+            INSERT INTO {SCHEMA}.{table} (id, {key_col}, sender_id, text, msg_type, file_url, file_name, duration, created_at)
+            SELECT message_id, $1, $2, $4, $5, $6, $7, $8, created_at FROM send_key
+            RETURNING id, created_at
+        ), summary AS (
+            UPDATE {SCHEMA}.{chats} SET last_message_at = GREATEST(last_message_at, msg.created_at)
+            FROM msg WHERE {chats}.id = $1
+            RETURNING {summary}
+        ){notify}
+        SELECT id, created_at FROM msg
+    """, args)
+    return cur.fetchone()
+
+
+def find_sent(cur, kind, sender_id, client_msg_id):
+    """The message a previous send with this client_msg_id created: (id, created_at, file_url)"""
+    table = "chat_messages" if kind == "chat" else "group_messages"
+    cur.execute(f"""
+        SELECT k.message_id, k.created_at, m.file_url
+        FROM {SCHEMA}.message_send_keys k
+        LEFT JOIN {SCHEMA}.{table} m ON m.id = k.message_id AND m.created_at = k.created_at
+        WHERE k.sender_id=%s AND k.kind=%s AND k.client_msg_id=%s
+    """, (sender_id, kind, client_msg_id))
+    return cur.fetchone()
+
+
+class InvalidCursor(ValueError):
+    """A paging cursor that did not come from encode_cursor; answered with 400"""
+
+
+def param_limit(params, name, default, maximum):
+    """Page size from the query string, clamped to 1..maximum"""
+    try:
+        value = int(params.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    return max(1, min(value, maximum))
+
+
+def encode_cursor(created_at, msg_id):
+    micros = (created_at - EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{micros}:{msg_id}"
+
+
+def decode_cursor(value):
+    if not value:
+        return None
+    try:
+        micros, msg_id = value.split(":")
+        return EPOCH + datetime.timedelta(microseconds=int(micros)), int(msg_id)
+    except (ValueError, OverflowError) as e:
+        raise InvalidCursor(value) from e
+
+
+def page_messages(cur, table, key_col, owner_id, before, limit):
+    """Newest-first page of hot rows older than `before`; the created_at bound lets the planner prune partitions"""
+    if before:
+        prepared.execute(cur, f"{table}_page_before", f"""
+            SELECT {MESSAGE_COLUMNS} FROM {SCHEMA}.{table}
+            WHERE {key_col}=$1 AND created_at <= $2 AND (created_at, id) < ($2, $3) AND deleted_at IS NULL
+            ORDER BY created_at DESC, id DESC
+            LIMIT $4
+        """, (owner_id, before[0], before[1], limit))
+    else:
+        prepared.execute(cur, f"{table}_page", f"""
+            SELECT {MESSAGE_COLUMNS} FROM {SCHEMA}.{table}
+            WHERE {key_col}=$1 AND deleted_at IS NULL
+            ORDER BY created_at DESC, id DESC
+            LIMIT $2
+        """, (owner_id, limit))
+    return cur.fetchall()
+
+
+def page_archive(cur, kind, owner_id, before, limit):
+    """Continues a newest-first page from the monthly archives in the bucket"""
+    cond = ""
+    args = [kind, owner_id]
+    if before:
+        cond = "AND period <= %s"
+        args.append(before[0])
+    cur.execute(f"""
+        SELECT s3_key FROM {SCHEMA}.message_archives
+        WHERE kind=%s AND owner_id=%s {cond}
+        ORDER BY period DESC
+    """, args)
+    keys = [r[0] for r in cur.fetchall()]
+    rows = []
+    s3 = get_s3() if keys else None
+    for key in keys:
+        obj = s3.get_object(Bucket="files", Key=key)
+        for line in gzip.decompress(obj["Body"].read()).splitlines():
+            m = json.loads(line)
+            created_at = datetime.datetime.fromisoformat(m["created_at"])
+            if before and (created_at, m["id"]) >= before:
+                continue
+            rows.append((m["id"], m["sender_id"], m["text"], m["msg_type"],
+                         m["file_url"], m["file_name"], m["duration"], created_at))
+        if len(rows) >= limit:
+            break
+    rows.sort(key=lambda r: (r[7], r[0]), reverse=True)
+    return rows[:limit]
+
+
+def has_archive(cur, kind, owner_id):
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {SCHEMA}.message_archives WHERE kind=%s AND owner_id=%s)",
+                (kind, owner_id))
+    return cur.fetchone()[0]
+
+
+def load_history(cur, kind, owner_id, before, limit):
+    """Oldest-first page ending at `before`, plus the next cursor.
+
+    Only an explicit `before` continues into the archive: the latest page is polled every few seconds and must
+    stay on hot rows. When that page runs out with archives left, the cursor still points past its oldest row.
+    """
+    table, key_col = ("chat_messages", "chat_id") if kind == "chat" else ("group_messages", "group_id")
+    rows = page_messages(cur, table, key_col, owner_id, before, limit)
+    older = (rows[-1][7], rows[-1][0]) if rows else before
+    if len(rows) < limit and before:
+        rows += page_archive(cur, kind, owner_id, older, limit - len(rows))
+    if len(rows) == limit:
+        cursor = encode_cursor(rows[-1][7], rows[-1][0])
+    elif not before and has_archive(cur, kind, owner_id):
+        older = older or (datetime.datetime.now(datetime.timezone.utc), 0)
+        cursor = encode_cursor(*older)
+    else:
+        cursor = None
+    rows.reverse()
+    return rows, cursor
+
+
+def page_newer(cur, table, key_col, owner_id, after, limit, inclusive=False):
+    """Oldest-first page of rows newer than `after` (or starting at it when inclusive)"""
+    prepared.execute(cur, f"{table}_page_after{'_incl' if inclusive else ''}", f"""
+        SELECT {MESSAGE_COLUMNS} FROM {SCHEMA}.{table}
+        WHERE {key_col}=$1 AND created_at >= $2 AND (created_at, id) {'>=' if inclusive else '>'} ($2, $3)
+          AND deleted_at IS NULL
+        ORDER BY created_at, id
+        LIMIT $4
+    """, (owner_id, after[0], after[1], limit))
+    return cur.fetchall()
+
+
+def is_member(cur, kind, owner_id, user_id):
+    if kind == "chat":
+        cur.execute(f"SELECT 1 FROM {SCHEMA}.chats WHERE id=%s AND (user1_id=%s OR user2_id=%s)",
+                    (owner_id, user_id, user_id))
+    else:
+        cur.execute(f"SELECT 1 FROM {SCHEMA}.group_chat_members WHERE group_id=%s AND user_id=%s", (owner_id, user_id))
+    return cur.fetchone() is not None
+
+
+def chat_messages_json(cur, chat_id, user_id, rows):
+    """Messages as JSON plus the partner's id, read from the chat row alongside the read marks"""
+    prepared.execute(cur, "chat_members_marks", f"""
+        SELECT c.user1_id, c.user2_id, r.user_id, r.last_read_message_id
+        FROM {SCHEMA}.chats c LEFT JOIN {SCHEMA}.chat_read_marks r ON r.chat_id = c.id
+        WHERE c.id=$1
+    """, (chat_id,))
+    marks = cur.fetchall()
+    partner_id = None
+    if marks:
+        partner_id = marks[0][1] if marks[0][0] == user_id else marks[0][0]
+    my_mark = max((r[3] for r in marks if r[2] == user_id), default=0)
+    partner_mark = max((r[3] for r in marks if r[2] is not None and r[2] != user_id), default=0)
+    msgs = []
+    for row in rows:
+        msgs.append({
+            "id": row[0],
+            "from_me": row[1] == user_id,
+            "sender_id": row[1],
+            "text": row[2],
+            "type": row[3],
+            "file_url": row[4],
+            "file_name": row[5],
+            "duration": row[6],
+            "time": row[7].strftime("%H:%M"),
+            "is_read": row[0] <= (partner_mark if row[1] == user_id else my_mark),
+        })
+    return msgs, partner_id
+
+
+def group_messages_json(cur, user_id, rows):
+    senders = {}
+    if rows:
+        cur.execute(f"SELECT id, name, avatar FROM {SCHEMA}.users WHERE id = ANY(%s)",
+                    (list({r[1] for r in rows}),))
+        senders = {r[0]: r for r in cur.fetchall()}
+    msgs = []
+    for row in rows:
+        sender = senders.get(row[1], (row[1], "", ""))
+        msgs.append({
+            "id": row[0], "from_me": row[1] == user_id,
+            "sender_id": row[1], "sender_name": sender[1],
+            "sender_avatar": sender[2] or "", "text": row[2],
+            "type": row[3], "file_url": row[4], "file_name": row[5],
+            "duration": row[6], "time": row[7].strftime("%H:%M"),
+        })
+    return msgs
+
+
+def search_messages(cur, user_id, q, chat_id, group_id, after, limit):
+    """Full-text hits in the user's chats and groups (or in one of them), best match first.
+
+    Each table contributes at most its SEARCH_MATCHES newest matches; `after` is the
+    (rank, created_at, id) of the last hit on the previous page.
+    """
+    parts, args = [], []
+    if not group_id:
+        if chat_id:
+            scope, scope_args = "m.chat_id = %s", [chat_id]
+        else:
+            scope, scope_args = f"m.chat_id IN (SELECT id FROM {SCHEMA}.chats WHERE user1_id=%s OR user2_id=%s)", [user_id, user_id]
+        parts.append(("chat", "chat_messages", "chat_id", scope, scope_args))
+    if not chat_id:
+        if group_id:
+            scope, scope_args = "m.group_id = %s", [group_id]
+        else:
+            scope, scope_args = f"m.group_id IN (SELECT group_id FROM {SCHEMA}.group_chat_members WHERE user_id=%s)", [user_id]
+        parts.append(("group", "group_messages", "group_id", scope, scope_args))
+    selects = []
+    for kind, table, key_col, scope, scope_args in parts:
+        # text <> '' and the russian config match the partial GIN index
+        selects.append(f"""
+            (SELECT '{kind}' AS kind, m.{key_col} AS owner_id, m.id, m.sender_id, m.text, m.created_at,
+                    ts_rank(to_tsvector('russian', m.text), websearch_to_tsquery('russian', %s)) AS rank
+             FROM {SCHEMA}.{table} m
+             WHERE {scope} AND m.text <> '' AND to_tsvector('russian', m.text) @@ websearch_to_tsquery('russian', %s)
+             ORDER BY m.created_at DESC LIMIT {SEARCH_MATCHES})""")
+        args += [q] + scope_args + [q]
+    cond = ""
+    if after:
+        cond = "WHERE (rank, created_at, id) < (%s::real, %s, %s)"
+        args += list(after)
+    # Headlines are built only for the page, not for every ranked match
+    cur.execute(f"""
+        SELECT h.kind, h.owner_id, h.id, h.sender_id, u.name, h.created_at, h.rank,
+               ts_headline('russian', h.text, websearch_to_tsquery('russian', %s), %s)
+        FROM (
+            SELECT * FROM ({" UNION ALL ".join(selects)}) hits {cond}
+            ORDER BY rank DESC, created_at DESC, id DESC
+            LIMIT %s
+        ) h
+        LEFT JOIN {SCHEMA}.users u ON u.id = h.sender_id
+        ORDER BY h.rank DESC, h.created_at DESC, h.id DESC
+    """, [q, HEADLINE_OPTIONS] + args + [limit])
+    rows = cur.fetchall()
+    cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        cursor = f"{last[6]!r}:{encode_cursor(last[5], last[2])}"
+    return rows, cursor
+
+
+def decode_search_cursor(value):
+    if not value:
+        return None
+    try:
+        rank, micros, msg_id = value.split(":")
+        return float(rank), EPOCH + datetime.timedelta(microseconds=int(micros)), int(msg_id)
+    except (ValueError, OverflowError) as e:
+        raise InvalidCursor(value) from e
+
+
+def page_follows(cur, user_col, other_col, user_id, before, limit):
+    """Newest-first page of follow edges of user_id, joined to the user on the other end"""
+    cond = ""
+    args = [user_id]
+    if before:
+        cond = f"AND (f.created_at, f.{other_col}) < (%s, %s)"
+        args += [before[0], before[1]]
+    cur.execute(f"""
+        SELECT u.id, u.name, u.handle, u.avatar, u.bio, f.created_at
+        FROM {SCHEMA}.follows f JOIN {SCHEMA}.users u ON u.id = f.{other_col}
+        WHERE f.{user_col} = %s {cond}
+        ORDER BY f.created_at DESC, f.{other_col} DESC
+        LIMIT %s
+    """, args + [limit])
+    rows = cur.fetchall()
+    cursor = encode_cursor(rows[-1][5], rows[-1][0]) if len(rows) == limit else None
+    return rows, cursor
+
+
+def presence_lookup(user_ids, keys):
+    """Last heartbeats of user_ids and who is typing in each chat key; empty if the store is down"""
+    try:
+        return presence.get_store().lookup(user_ids, keys)
+    except presence.store_errors():
+        log_metric("presence", decision="unavailable")
+        return {}, {}
+
+
+def last_seen(seen, user_id):
+    ts = seen.get(user_id)
+    return time_ago(datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)) if ts else ""
+
+
+def presence_route(event):
+    """heartbeat, typing and presence only touch the TTL store, never Postgres"""
+    if event.get("httpMethod", "GET") == "GET":
+        params = event.get("queryStringParameters") or {}
+        action = params.get("action", "list")
+    else:
+        params = json.loads(event.get("body") or "{}")
+        action = params.get("action")
+    if action not in PRESENCE_ACTIONS:
+        return None
+    try:
+        user_id = int(params.get("user_id", 0))
+        owner_id = int(params.get("group_id") or params.get("chat_id") or 0)
+        ids = [int(u) for u in str(params.get("user_ids", "")).split(",") if u.strip()][:100]
+    except (TypeError, ValueError):
+        return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Некорректный запрос"})}
+    key = presence.chat_key("group" if params.get("group_id") else "chat", owner_id)
+    try:
+        store = presence.get_store()
+        if action == "heartbeat":
+            store.heartbeat(user_id)
+            result = {"ok": True}
+        elif action == "typing":
+            # Query strings carry "false"/"0" as text; JSON bodies may send a real boolean
+            store.set_typing(key, user_id, str(params.get("typing", True)).lower() not in ("0", "false", ""))
+            result = {"ok": True}
+        else:
+            seen, typing = store.lookup(ids, [key])
+            result = {
+                "users": {uid: {"online": presence.is_online(seen, uid), "last_seen": last_seen(seen, uid)} for uid in ids},
+                "typing": sorted(typing.get(key, set()) - {user_id}),
+            }
+    except presence.store_errors():
+        log_metric("presence", decision="unavailable")
+        return {"statusCode": 503, "headers": CORS, "body": json.dumps({"error": "Статус недоступен"})}
+    return {"statusCode": 200, "headers": CORS, "body": json.dumps(result)}
+
+
+@admission.guard(FUNCTION, CORS, reads=READ_ACTIONS | {"history", "group_history", "batch"}, db_free=PRESENCE_ACTIONS,
+                 default_action="list")
 def handler(event: dict, context) -> dict:
     """Личные сообщения Eclipse: чаты, сообщения, голосовые, группы"""
     if event.get("httpMethod") == "OPTIONS":
         return {"statusCode": 200, "headers": CORS, "body": ""}
 
+    resp = presence_route(event)
+    if resp:
+        return resp
+
+    read = routing.is_read_request(event)
+    if read and db_routing.REPLICA_URLS:
+        headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+        params = event.get("queryStringParameters") or {}
+        conn = get_read_conn(headers.get("x-session-lsn") or params.get("min_lsn"))
+    else:
+        conn = get_conn()
+    try:
+        resp = route(event, conn)
+        if db_routing.REPLICA_URLS and not read and resp["statusCode"] == 200:
+            log_metric("db_route", target="primary", decision="write")
+            resp = routing.with_session_lsn(resp, conn)
+        return resp
+    finally:
+        conn.close()
+
+
+def route(event: dict, conn) -> dict:
     method = event.get("httpMethod", "GET")
-    conn = get_conn()
     cur = conn.cursor()
 
     try:
@@ -55,142 +493,195 @@ def handler(event: dict, context) -> dict:
             action = params.get("action", "list")
 
             if action == "list":
-                # Get all direct chats for user
-                cur.execute(f"""
-                    SELECT c.id,
-                           CASE WHEN c.user1_id = %s THEN c.user2_id ELSE c.user1_id END as partner_id,
+                # Direct chats and groups in one round trip; the first column tells them apart
+                prepared.execute(cur, "messages_list", f"""
+                    SELECT 'chat', c.id,
+                           CASE WHEN c.user1_id = $1 THEN c.user2_id ELSE c.user1_id END as partner_id,
                            u.name, u.handle, u.avatar,
                            cm.text, cm.msg_type, cm.created_at, cm.sender_id,
-                           (SELECT COUNT(*) FROM {SCHEMA}.chat_messages WHERE chat_id=c.id AND is_read=FALSE AND sender_id != %s) as unread
+                           (SELECT COUNT(*) FROM {SCHEMA}.chat_messages
+                            WHERE chat_id=c.id AND id > COALESCE(r.last_read_message_id, 0) AND sender_id != $1
+                              AND deleted_at IS NULL) as unread,
+                           NULL::bigint as member_count,
+                           COALESCE(c.last_message_at, c.created_at) as sort_at
                     FROM {SCHEMA}.chats c
-                    JOIN {SCHEMA}.users u ON u.id = CASE WHEN c.user1_id = %s THEN c.user2_id ELSE c.user1_id END
-                    LEFT JOIN {SCHEMA}.chat_messages cm ON cm.id = (
-                        SELECT id FROM {SCHEMA}.chat_messages WHERE chat_id=c.id ORDER BY created_at DESC LIMIT 1
-                    )
-                    WHERE c.user1_id = %s OR c.user2_id = %s
-                    ORDER BY COALESCE(cm.created_at, c.created_at) DESC
-                """, (user_id, user_id, user_id, user_id, user_id))
-
-                chats = []
-                for row in cur.fetchall():
-                    last_text = ""
-                    if row[5] is not None:
-                        if row[6] == "voice":
-                            last_text = "🎤 Голосовое"
-                        elif row[6] == "image":
-                            last_text = "🖼 Фото"
-                        elif row[6] == "file":
-                            last_text = "📎 Файл"
-                        else:
-                            last_text = row[5][:60]
-                    chats.append({
-                        "chat_id": row[0],
-                        "partner_id": row[1],
-                        "partner_name": row[2],
-                        "partner_handle": f"@{row[3]}",
-                        "partner_avatar": row[4] or "",
-                        "last_msg": last_text,
-                        "last_time": time_ago(row[7]) if row[7] else "",
-                        "unread": int(row[9]),
-                        "is_mine": row[8] == user_id if row[8] else False,
-                    })
-
-                # Get group chats
-                cur.execute(f"""
-                    SELECT gc.id, gc.name, gc.avatar,
+                    JOIN {SCHEMA}.users u ON u.id = CASE WHEN c.user1_id = $1 THEN c.user2_id ELSE c.user1_id END
+                    LEFT JOIN {SCHEMA}.chat_read_marks r ON r.chat_id = c.id AND r.user_id = $1
+                    LEFT JOIN LATERAL (
+                        SELECT text, msg_type, created_at, sender_id FROM {SCHEMA}.chat_messages
+                        WHERE chat_id=c.id AND deleted_at IS NULL ORDER BY created_at DESC LIMIT 1
+                    ) cm ON TRUE
+                    WHERE c.user1_id = $1 OR c.user2_id = $1
+                    UNION ALL
+                    SELECT 'group', gc.id, NULL, gc.name, NULL, gc.avatar,
                            gm.text, gm.msg_type, gm.created_at, gm.sender_id,
-                           (SELECT COUNT(*) FROM {SCHEMA}.group_chat_members WHERE group_id=gc.id) as member_count
+                           (SELECT COUNT(*) FROM {SCHEMA}.group_messages
+                            WHERE group_id=gc.id AND id > COALESCE(r.last_read_message_id, 0) AND sender_id != $1
+                              AND deleted_at IS NULL) as unread,
+                           (SELECT COUNT(*) FROM {SCHEMA}.group_chat_members WHERE group_id=gc.id) as member_count,
+                           COALESCE(gc.last_message_at, gc.created_at) as sort_at
                     FROM {SCHEMA}.group_chats gc
-                    JOIN {SCHEMA}.group_chat_members gcm ON gcm.group_id=gc.id AND gcm.user_id=%s
-                    LEFT JOIN {SCHEMA}.group_messages gm ON gm.id = (
-                        SELECT id FROM {SCHEMA}.group_messages WHERE group_id=gc.id ORDER BY created_at DESC LIMIT 1
-                    )
-                    ORDER BY COALESCE(gm.created_at, gc.created_at) DESC
+                    JOIN {SCHEMA}.group_chat_members gcm ON gcm.group_id=gc.id AND gcm.user_id=$1
+                    LEFT JOIN {SCHEMA}.group_read_marks r ON r.group_id = gc.id AND r.user_id = $1
+                    LEFT JOIN LATERAL (
+                        SELECT text, msg_type, created_at, sender_id FROM {SCHEMA}.group_messages
+                        WHERE group_id=gc.id AND deleted_at IS NULL ORDER BY created_at DESC LIMIT 1
+                    ) gm ON TRUE
+                    ORDER BY 1, 13 DESC
                 """, (user_id,))
 
+                chats = []
                 groups = []
                 for row in cur.fetchall():
                     last_text = ""
-                    if row[3] is not None:
-                        if row[4] == "voice":
+                    if row[6] is not None:
+                        if row[7] == "voice":
                             last_text = "🎤 Голосовое"
-                        elif row[4] == "image":
+                        elif row[7] == "image":
                             last_text = "🖼 Фото"
+                        elif row[7] == "file" and row[0] == "chat":
+                            last_text = "📎 Файл"
                         else:
-                            last_text = row[3][:60]
-                    groups.append({
-                        "group_id": row[0],
-                        "name": row[1],
-                        "avatar": row[2] or "",
-                        "last_msg": last_text,
-                        "last_time": time_ago(row[5]) if row[5] else "",
-                        "member_count": int(row[7]),
-                        "is_group": True,
-                    })
+                            last_text = row[6][:60]
+                    if row[0] == "chat":
+                        chats.append({
+                            "chat_id": row[1],
+                            "partner_id": row[2],
+                            "partner_name": row[3],
+                            "partner_handle": f"@{row[4]}",
+                            "partner_avatar": row[5] or "",
+                            "last_msg": last_text,
+                            "last_time": time_ago(row[8]) if row[8] else "",
+                            "unread": int(row[10]),
+                            "is_mine": row[9] == user_id if row[9] else False,
+                        })
+                    else:
+                        groups.append({
+                            "group_id": row[1],
+                            "name": row[3],
+                            "avatar": row[5] or "",
+                            "last_msg": last_text,
+                            "last_time": time_ago(row[8]) if row[8] else "",
+                            "member_count": int(row[11]),
+                            "unread": int(row[10]),
+                            "is_group": True,
+                        })
+
+                seen, typing = presence_lookup(
+                    [c["partner_id"] for c in chats],
+                    [presence.chat_key("chat", c["chat_id"]) for c in chats]
+                    + [presence.chat_key("group", g["group_id"]) for g in groups])
+                now = time.time()
+                for c in chats:
+                    c["partner_online"] = presence.is_online(seen, c["partner_id"], now)
+                    c["partner_last_seen"] = last_seen(seen, c["partner_id"])
+                    c["typing"] = c["partner_id"] in typing.get(presence.chat_key("chat", c["chat_id"]), ())
+                for g in groups:
+                    g["typing"] = bool(typing.get(presence.chat_key("group", g["group_id"]), set()) - {user_id})
 
                 return {"statusCode": 200, "headers": CORS, "body": json.dumps({"chats": chats, "groups": groups})}
 
             elif action == "history":
                 chat_id = int(params.get("chat_id", 0))
-                user_id_val = user_id
-                cur.execute(f"""
-                    SELECT id, sender_id, text, msg_type, file_url, file_name, duration, created_at, is_read
-                    FROM {SCHEMA}.chat_messages
-                    WHERE chat_id=%s
-                    ORDER BY created_at ASC
-                    LIMIT 100
-                """, (chat_id,))
-                msgs = []
-                for row in cur.fetchall():
-                    msgs.append({
-                        "id": row[0],
-                        "from_me": row[1] == user_id_val,
-                        "sender_id": row[1],
-                        "text": row[2],
-                        "type": row[3],
-                        "file_url": row[4],
-                        "file_name": row[5],
-                        "duration": row[6],
-                        "time": row[7].strftime("%H:%M"),
-                        "is_read": row[8],
-                    })
+                limit = param_limit(params, "limit", 100, 100)
+                before = decode_cursor(params.get("before"))
+                after = decode_cursor(params.get("after"))
+                if after:
+                    rows = page_newer(cur, "chat_messages", "chat_id", chat_id, after, limit)
+                    cursor = encode_cursor(rows[-1][7], rows[-1][0]) if len(rows) == limit else None
+                else:
+                    rows, cursor = load_history(cur, "chat", chat_id, before, limit)
+                msgs, partner_id = chat_messages_json(cur, chat_id, user_id, rows)
                 # Mark messages as read
-                cur.execute(f"""
-                    UPDATE {SCHEMA}.chat_messages SET is_read=TRUE
-                    WHERE chat_id=%s AND sender_id != %s AND is_read=FALSE
-                """, (chat_id, user_id_val))
-                conn.commit()
-                return {"statusCode": 200, "headers": CORS, "body": json.dumps({"messages": msgs})}
+                if not before and not after:
+                    mark_chat_read(cur, chat_id, user_id)
+                    conn.commit()
+                key = presence.chat_key("chat", chat_id)
+                seen, typing = presence_lookup([partner_id] if partner_id else [], [key])
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({
+                    "messages": msgs, "cursor": cursor,
+                    "partner_online": presence.is_online(seen, partner_id),
+                    "partner_last_seen": last_seen(seen, partner_id),
+                    "typing": partner_id in typing.get(key, ()),
+                })}
 
             elif action == "group_history":
                 group_id = int(params.get("group_id", 0))
-                cur.execute(f"""
-                    SELECT gm.id, gm.sender_id, u.name, u.avatar, gm.text, gm.msg_type, gm.file_url, gm.file_name, gm.duration, gm.created_at
-                    FROM {SCHEMA}.group_messages gm
-                    JOIN {SCHEMA}.users u ON u.id=gm.sender_id
-                    WHERE gm.group_id=%s
-                    ORDER BY gm.created_at ASC
-                    LIMIT 100
-                """, (group_id,))
-                msgs = []
-                for row in cur.fetchall():
-                    msgs.append({
-                        "id": row[0], "from_me": row[1] == user_id,
-                        "sender_id": row[1], "sender_name": row[2],
-                        "sender_avatar": row[3] or "", "text": row[4],
-                        "type": row[5], "file_url": row[6], "file_name": row[7],
-                        "duration": row[8], "time": row[9].strftime("%H:%M"),
-                    })
-                return {"statusCode": 200, "headers": CORS, "body": json.dumps({"messages": msgs})}
+                limit = param_limit(params, "limit", 100, 100)
+                before = decode_cursor(params.get("before"))
+                after = decode_cursor(params.get("after"))
+                if after:
+                    rows = page_newer(cur, "group_messages", "group_id", group_id, after, limit)
+                    cursor = encode_cursor(rows[-1][7], rows[-1][0]) if len(rows) == limit else None
+                else:
+                    rows, cursor = load_history(cur, "group", group_id, before, limit)
+                msgs = group_messages_json(cur, user_id, rows)
+                if user_id and not before and not after:
+                    mark_group_read(cur, group_id, user_id)
+                    conn.commit()
+                key = presence.chat_key("group", group_id)
+                _, typing = presence_lookup([], [key])
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({
+                    "messages": msgs, "cursor": cursor,
+                    "typing_user_ids": sorted(typing.get(key, set()) - {user_id}),
+                })}
+
+            elif action == "search_chat":
+                q = (params.get("q") or "").strip()
+                chat_id = int(params.get("chat_id", 0))
+                group_id = int(params.get("group_id", 0))
+                limit = param_limit(params, "limit", 20, 50)
+                if not q:
+                    return {"statusCode": 200, "headers": CORS, "body": json.dumps({"results": [], "cursor": None})}
+                if (chat_id and not is_member(cur, "chat", chat_id, user_id)) or \
+                        (group_id and not is_member(cur, "group", group_id, user_id)):
+                    return {"statusCode": 403, "headers": CORS, "body": json.dumps({"error": "Нет доступа"})}
+                rows, cursor = search_messages(cur, user_id, q, chat_id, group_id,
+                                               decode_search_cursor(params.get("cursor")), limit)
+                results = [{
+                    "kind": r[0], f"{r[0]}_id": r[1], "id": r[2],
+                    "sender_id": r[3], "sender_name": r[4] or "", "from_me": r[3] == user_id,
+                    "snippet": r[7], "time": time_ago(r[5]),
+                    # Passed back to context to open the chat at this message
+                    "position": encode_cursor(r[5], r[2]),
+                } for r in rows]
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({"results": results, "cursor": cursor})}
+
+            elif action == "context":
+                kind = "group" if params.get("group_id") else "chat"
+                owner_id = int(params.get("group_id") or params.get("chat_id") or 0)
+                table, key_col = ("chat_messages", "chat_id") if kind == "chat" else ("group_messages", "group_id")
+                n = param_limit(params, "n", 20, 50)
+                if not is_member(cur, kind, owner_id, user_id):
+                    return {"statusCode": 403, "headers": CORS, "body": json.dumps({"error": "Нет доступа"})}
+                anchor = decode_cursor(params.get("position"))
+                if not anchor:
+                    # Without the search position the message's partition is unknown: probe by (owner, id)
+                    cur.execute(f"SELECT created_at, id FROM {SCHEMA}.{table} WHERE {key_col}=%s AND id=%s",
+                                (owner_id, int(params.get("message_id", 0))))
+                    anchor = cur.fetchone()
+                newer = page_newer(cur, table, key_col, owner_id, anchor, n + 1, inclusive=True) if anchor else []
+                if not newer or (newer[0][7], newer[0][0]) != tuple(anchor):
+                    return {"statusCode": 404, "headers": CORS, "body": json.dumps({"error": "Сообщение не найдено"})}
+                older, before = load_history(cur, kind, owner_id, tuple(anchor), n)
+                rows = older + newer
+                after = encode_cursor(newer[-1][7], newer[-1][0]) if len(newer) == n + 1 else None
+                if kind == "chat":
+                    msgs, _ = chat_messages_json(cur, owner_id, user_id, rows)
+                else:
+                    msgs = group_messages_json(cur, user_id, rows)
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({
+                    "messages": msgs, "anchor_id": anchor[1], "before": before, "after": after,
+                })}
 
             # ── Social GET actions ─────────────────────────────────────────────
             elif action == "notifications":
-                cur.execute(f"""
+                prepared.execute(cur, "messages_notifications", f"""
                     SELECT n.id, n.type, n.message, n.is_read, n.created_at,
                            u.id, u.name, u.handle, u.avatar, n.post_id
                     FROM {SCHEMA}.notifications n
                     LEFT JOIN {SCHEMA}.users u ON u.id = n.from_user_id
-                    WHERE n.user_id = %s ORDER BY n.created_at DESC LIMIT 50
+                    WHERE n.user_id = $1 ORDER BY n.created_at DESC LIMIT 50
                 """, (user_id,))
                 notifs = [{"id": r[0], "type": r[1], "message": r[2], "is_read": r[3],
                            "time": time_ago(r[4]), "from_id": r[5], "from_name": r[6],
@@ -198,50 +689,65 @@ def handler(event: dict, context) -> dict:
                            "from_avatar": r[8] or "", "post_id": r[9]}
                           for r in cur.fetchall()]
                 unread_count = sum(1 for n in notifs if not n["is_read"])
-                cur.execute(f"""
-                    SELECT COUNT(*) FROM {SCHEMA}.chat_messages cm
-                    JOIN {SCHEMA}.chats c ON c.id = cm.chat_id
-                    WHERE (c.user1_id=%s OR c.user2_id=%s) AND cm.sender_id != %s AND cm.is_read=FALSE
-                """, (user_id, user_id, user_id))
-                unread_msg_count = int(cur.fetchone()[0])
+                prepared.execute(cur, "messages_unread_totals", f"""
+                    SELECT (SELECT COUNT(*) FROM {SCHEMA}.chats c
+                            LEFT JOIN {SCHEMA}.chat_read_marks r ON r.chat_id = c.id AND r.user_id = $1
+                            JOIN {SCHEMA}.chat_messages cm ON cm.chat_id = c.id AND cm.id > COALESCE(r.last_read_message_id, 0)
+                            WHERE (c.user1_id=$1 OR c.user2_id=$1) AND cm.sender_id != $1 AND cm.deleted_at IS NULL),
+                           (SELECT COUNT(*) FROM {SCHEMA}.group_chat_members gcm
+                            LEFT JOIN {SCHEMA}.group_read_marks r ON r.group_id = gcm.group_id AND r.user_id = gcm.user_id
+                            JOIN {SCHEMA}.group_messages gm ON gm.group_id = gcm.group_id AND gm.id > COALESCE(r.last_read_message_id, 0)
+                            WHERE gcm.user_id=$1 AND gm.sender_id != $1 AND gm.deleted_at IS NULL)
+                """, (user_id,))
+                unread_msg_count, unread_group_msg_count = (int(v) for v in cur.fetchone())
                 return {"statusCode": 200, "headers": CORS, "body": json.dumps({
                     "notifications": notifs, "unread_count": unread_count,
                     "unread_msg_count": unread_msg_count,
+                    "unread_group_msg_count": unread_group_msg_count,
                 })}
 
-            elif action == "following":
-                cur.execute(f"""
-                    SELECT u.id, u.name, u.handle, u.avatar, u.bio
-                    FROM {SCHEMA}.follows f JOIN {SCHEMA}.users u ON u.id = f.following_id
-                    WHERE f.follower_id = %s ORDER BY f.created_at DESC
-                """, (user_id,))
-                users = [{"id": r[0], "name": r[1], "handle": f"@{r[2]}", "avatar": r[3] or "", "bio": r[4] or ""} for r in cur.fetchall()]
-                return {"statusCode": 200, "headers": CORS, "body": json.dumps({"users": users})}
-
-            elif action == "followers":
-                cur.execute(f"""
-                    SELECT u.id, u.name, u.handle, u.avatar, u.bio
-                    FROM {SCHEMA}.follows f JOIN {SCHEMA}.users u ON u.id = f.follower_id
-                    WHERE f.following_id = %s ORDER BY f.created_at DESC
-                """, (user_id,))
-                users = [{"id": r[0], "name": r[1], "handle": f"@{r[2]}", "avatar": r[3] or "", "bio": r[4] or ""} for r in cur.fetchall()]
+            elif action in ("following", "followers"):
+                limit = param_limit(params, "limit", 50, 100)
+                before = decode_cursor(params.get("before"))
+                graph = follow_graph.get_graph(cur, SCHEMA)
+                if action == "following":
+                    rows, cursor = page_follows(cur, "follower_id", "following_id", user_id, before, limit)
+                    mutual = [graph.is_following(r[0], user_id) for r in rows]
+                else:
+                    rows, cursor = page_follows(cur, "following_id", "follower_id", user_id, before, limit)
+                    mutual = [graph.is_following(user_id, r[0]) for r in rows]
+                users = [{"id": r[0], "name": r[1], "handle": f"@{r[2]}", "avatar": r[3] or "", "bio": r[4] or "",
+                          "mutual": m} for r, m in zip(rows, mutual)]
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({"users": users, "cursor": cursor})}
+
+            elif action == "suggestions":
+                limit = param_limit(params, "limit", 10, 50)
+                ranked = follow_graph.get_graph(cur, SCHEMA).suggestions(user_id, limit)
+                users = []
+                if ranked:
+                    cur.execute(f"SELECT id, name, handle, avatar, bio FROM {SCHEMA}.users WHERE id = ANY(%s)",
+                                ([uid for uid, _ in ranked],))
+                    found = {r[0]: r for r in cur.fetchall()}
+                    for uid, common in ranked:
+                        r = found.get(uid)
+                        if r:
+                            users.append({"id": r[0], "name": r[1], "handle": f"@{r[2]}", "avatar": r[3] or "",
+                                          "bio": r[4] or "", "common": common})
                 return {"statusCode": 200, "headers": CORS, "body": json.dumps({"users": users})}
 
             elif action == "counts":
                 target_id = int(params.get("target_id", user_id))
-                cur.execute(f"SELECT COUNT(*) FROM {SCHEMA}.follows WHERE follower_id=%s", (target_id,))
-                following_count = int(cur.fetchone()[0])
-                cur.execute(f"SELECT COUNT(*) FROM {SCHEMA}.follows WHERE following_id=%s", (target_id,))
-                followers_count = int(cur.fetchone()[0])
-                cur.execute(f"SELECT COUNT(*) FROM {SCHEMA}.posts WHERE user_id=%s", (target_id,))
-                posts_count = int(cur.fetchone()[0])
-                is_following = False
-                if user_id and user_id != target_id:
-                    cur.execute(f"SELECT 1 FROM {SCHEMA}.follows WHERE follower_id=%s AND following_id=%s", (user_id, target_id))
-                    is_following = cur.fetchone() is not None
+                prepared.execute(cur, "messages_counts", f"""
+                    SELECT (SELECT COUNT(*) FROM {SCHEMA}.follows WHERE follower_id=$1),
+                           (SELECT COUNT(*) FROM {SCHEMA}.follows WHERE following_id=$1),
+                           (SELECT COUNT(*) FROM {SCHEMA}.posts WHERE user_id=$1 AND deleted_at IS NULL),
+                           $2 <> 0 AND $2 <> $1 AND EXISTS (
+                               SELECT 1 FROM {SCHEMA}.follows WHERE follower_id=$2 AND following_id=$1)
+                """, (target_id, user_id))
+                following_count, followers_count, posts_count, is_following = cur.fetchone()
                 return {"statusCode": 200, "headers": CORS, "body": json.dumps({
-                    "following_count": following_count, "followers_count": followers_count,
-                    "posts_count": posts_count, "is_following": is_following,
+                    "following_count": int(following_count), "followers_count": int(followers_count),
+                    "posts_count": int(posts_count), "is_following": is_following,
                 })}
 
             elif action == "liked_posts":
@@ -251,7 +757,7 @@ def handler(event: dict, context) -> dict:
                     FROM {SCHEMA}.post_likes pl
                     JOIN {SCHEMA}.posts p ON p.id = pl.post_id
                     JOIN {SCHEMA}.users u ON u.id = p.user_id
-                    WHERE pl.user_id = %s ORDER BY pl.post_id DESC LIMIT 50
+                    WHERE pl.user_id = %s AND p.deleted_at IS NULL ORDER BY pl.post_id DESC LIMIT 50
                 """, (user_id,))
                 posts = [{"id": r[0], "text": r[1], "likes": r[2],
                           "media_url": r[4], "media_type": r[5],
@@ -262,18 +768,21 @@ def handler(event: dict, context) -> dict:
         body = json.loads(event.get("body") or "{}")
         action = body.get("action")
 
-        if action == "get_or_create_chat":
+        if action == "batch":
+            return routing.run_batch(conn, body.get("requests") or [], route)
+
+        elif action == "get_or_create_chat":
             user1 = int(body["user_id"])
             user2 = int(body["partner_id"])
             lo, hi = min(user1, user2), max(user1, user2)
-            cur.execute(f"SELECT id FROM {SCHEMA}.chats WHERE user1_id=%s AND user2_id=%s", (lo, hi))
-            row = cur.fetchone()
-            if row:
-                chat_id = row[0]
-            else:
-                cur.execute(f"INSERT INTO {SCHEMA}.chats (user1_id, user2_id) VALUES (%s, %s) RETURNING id", (lo, hi))
-                chat_id = cur.fetchone()[0]
-                conn.commit()
+            # A no-op update rather than DO NOTHING so the row comes back even when the partner created it first
+            cur.execute(f"""
+                INSERT INTO {SCHEMA}.chats (user1_id, user2_id) VALUES (%s, %s)
+                ON CONFLICT (user1_id, user2_id) DO UPDATE SET user1_id = EXCLUDED.user1_id
+                RETURNING id
+            """, (lo, hi))
+            chat_id = cur.fetchone()[0]
+            conn.commit()
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"chat_id": chat_id})}
 
         elif action == "send":
@@ -283,39 +792,39 @@ def handler(event: dict, context) -> dict:
             msg_type = body.get("type", "text")
             file_name = body.get("file_name")
             duration = body.get("duration")
+            client_msg_id = str(body.get("client_msg_id") or uuid.uuid4().hex)
+            if not CLIENT_MSG_ID.match(client_msg_id):
+                return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Некорректный client_msg_id"})}
             file_url = None
+            upload = None
 
             if msg_type in ("image", "file", "voice") and body.get("file_data"):
-                s3 = get_s3()
                 raw = base64.b64decode(body["file_data"])
-                key = f"chat/{chat_id}/{sender_id}_{datetime.datetime.now().timestamp()}"
+                # Keyed by the client id, so a retried upload overwrites instead of leaving a copy
+                key = f"chat/{chat_id}/{sender_id}_{client_msg_id}"
                 if file_name:
                     key += f"_{file_name}"
                 content_type = body.get("content_type", "application/octet-stream")
-                s3.put_object(Bucket="files", Key=key, Body=raw, ContentType=content_type)
+                upload = start_upload(key, raw, content_type)
                 ak = os.environ["AWS_ACCESS_KEY_ID"]
                 file_url = f"https://cdn.poehali.dev/projects/{ak}/bucket/{key}"
 
-            cur.execute(f"""
-                INSERT INTO {SCHEMA}.chat_messages (chat_id, sender_id, text, msg_type, file_url, file_name, duration)
-                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id, created_at
-            """, (chat_id, sender_id, text, msg_type, file_url, file_name, duration))
-            row = cur.fetchone()
+            row = send_message(cur, "chat", chat_id, sender_id, client_msg_id,
+                               text, msg_type, file_url, file_name, duration)
+            # The message only becomes visible once its file is in the bucket
+            if upload:
+                upload.result()
+            if row is None:
+                original = find_sent(cur, "chat", sender_id, client_msg_id)
+                conn.rollback()
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({
+                    "id": original[0],
+                    "time": original[1].strftime("%H:%M"),
+                    "file_url": original[2],
+                    "duplicate": True,
+                })}
             conn.commit()
 
-            # Create notification for recipient
-            cur2 = conn.cursor()
-            cur2.execute(f"SELECT user1_id, user2_id FROM {SCHEMA}.chats WHERE id=%s", (chat_id,))
-            chat = cur2.fetchone()
-            if chat:
-                recipient = chat[1] if chat[0] == sender_id else chat[0]
-                cur2.execute(f"""
-                    INSERT INTO {SCHEMA}.notifications (user_id, from_user_id, type, message)
-                    VALUES (%s, %s, 'message', %s)
-                """, (recipient, sender_id, text[:100] if text else "Медиа сообщение"))
-                conn.commit()
-            cur2.close()
-
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({
                 "id": row[0],
                 "time": row[1].strftime("%H:%M"),
@@ -329,22 +838,33 @@ def handler(event: dict, context) -> dict:
             msg_type = body.get("type", "text")
             file_name = body.get("file_name")
             duration = body.get("duration")
+            client_msg_id = str(body.get("client_msg_id") or uuid.uuid4().hex)
+            if not CLIENT_MSG_ID.match(client_msg_id):
+                return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Некорректный client_msg_id"})}
             file_url = None
+            upload = None
 
             if msg_type in ("image", "file", "voice") and body.get("file_data"):
-                s3 = get_s3()
                 raw = base64.b64decode(body["file_data"])
-                key = f"group/{group_id}/{sender_id}_{datetime.datetime.now().timestamp()}"
+                key = f"group/{group_id}/{sender_id}_{client_msg_id}"
                 content_type = body.get("content_type", "application/octet-stream")
-                s3.put_object(Bucket="files", Key=key, Body=raw, ContentType=content_type)
+                upload = start_upload(key, raw, content_type)
                 ak = os.environ["AWS_ACCESS_KEY_ID"]
                 file_url = f"https://cdn.poehali.dev/projects/{ak}/bucket/{key}"
 
-            cur.execute(f"""
-                INSERT INTO {SCHEMA}.group_messages (group_id, sender_id, text, msg_type, file_url, file_name, duration)
-                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id, created_at
-            """, (group_id, sender_id, text, msg_type, file_url, file_name, duration))
-            row = cur.fetchone()
+            row = send_message(cur, "group", group_id, sender_id, client_msg_id,
+                               text, msg_type, file_url, file_name, duration)
+            if upload:
+                upload.result()
+            if row is None:
+                original = find_sent(cur, "group", sender_id, client_msg_id)
+                conn.rollback()
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({
+                    "id": original[0],
+                    "time": original[1].strftime("%H:%M"),
+                    "file_url": original[2],
+                    "duplicate": True,
+                })}
             conn.commit()
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({
                 "id": row[0],
@@ -355,10 +875,14 @@ def handler(event: dict, context) -> dict:
         elif action == "mark_read":
             chat_id = int(body["chat_id"])
             user_id = int(body["user_id"])
-            cur.execute(f"""
-                UPDATE {SCHEMA}.chat_messages SET is_read=TRUE
-                WHERE chat_id=%s AND sender_id != %s AND is_read=FALSE
-            """, (chat_id, user_id))
+            mark_chat_read(cur, chat_id, user_id)
+            conn.commit()
+            return {"statusCode": 200, "headers": CORS, "body": json.dumps({"ok": True})}
+
+        elif action == "mark_group_read":
+            group_id = int(body["group_id"])
+            user_id = int(body["user_id"])
+            mark_group_read(cur, group_id, user_id)
             conn.commit()
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"ok": True})}
 
@@ -369,7 +893,11 @@ def handler(event: dict, context) -> dict:
             row = cur.fetchone()
             if not row or user_id not in (row[0], row[1]):
                 return {"statusCode": 403, "headers": CORS, "body": json.dumps({"error": "Нет доступа"})}
-            cur.execute(f"UPDATE {SCHEMA}.chat_messages SET text='' WHERE chat_id=%s AND sender_id=%s", (chat_id, user_id))
+            # Files go too; maintenance compaction later removes the rows and their objects in the bucket
+            cur.execute(f"""
+                UPDATE {SCHEMA}.chat_messages SET text='', file_url=NULL, file_name=NULL, deleted_at=NOW()
+                WHERE chat_id=%s AND sender_id=%s AND deleted_at IS NULL
+            """, (chat_id, user_id))
             conn.commit()
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"ok": True})}
 
@@ -380,8 +908,10 @@ def handler(event: dict, context) -> dict:
             cur.execute(f"INSERT INTO {SCHEMA}.group_chats (name, creator_id) VALUES (%s, %s) RETURNING id", (name, creator_id))
             group_id = cur.fetchone()[0]
             all_members = list(set([creator_id] + [int(m) for m in member_ids]))
-            for mid in all_members:
-                cur.execute(f"INSERT INTO {SCHEMA}.group_chat_members (group_id, user_id) VALUES (%s, %s)", (group_id, mid))
+            cur.execute(f"""
+                INSERT INTO {SCHEMA}.group_chat_members (group_id, user_id)
+                SELECT %s, unnest(%s::int[])
+            """, (group_id, all_members))
             conn.commit()
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"group_id": group_id})}
 
@@ -420,6 +950,7 @@ def handler(event: dict, context) -> dict:
                 """, (following_id, follower_id))
                 followed = True
             conn.commit()
+            follow_graph.record(follower_id, following_id, followed)
             cur.execute(f"SELECT COUNT(*) FROM {SCHEMA}.follows WHERE following_id=%s", (following_id,))
             followers_count = int(cur.fetchone()[0])
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"followed": followed, "followers_count": followers_count})}
@@ -436,6 +967,8 @@ def handler(event: dict, context) -> dict:
 
         return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Неизвестное действие"})}
 
+    except InvalidCursor:
+        return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Некорректный курсор"})}
+
     finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
+        cur.close()
\ No newline at end of file
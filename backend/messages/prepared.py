@@ -0,0 +1,34 @@
+import os
+import re
+import weakref
+import psycopg2
+import psycopg2.errors
+
+# Off behind a transaction-mode pooler, where consecutive statements may land on different sessions
+ENABLED = os.environ.get("DB_PREPARED_STATEMENTS", "1") != "0"
+
+_sessions = weakref.WeakKeyDictionary()
+
+
+def execute(cur, name, sql, args=()):
+    """Runs sql written with $1..$n placeholders as the named prepared statement `name`.
+
+    The first call on a connection sends PREPARE and EXECUTE in one round trip; later calls
+    send only EXECUTE, so Postgres skips parsing and, once it settles on a generic plan, planning.
+    """
+    if not ENABLED:
+        cur.execute(re.sub(r"\$(\d+)", r"%(p\1)s", sql), {f"p{i}": a for i, a in enumerate(args, 1)})
+        return
+    names = _sessions.setdefault(cur.connection, set())
+    call = f"EXECUTE {name}({', '.join(['%s'] * len(args))})" if args else f"EXECUTE {name}"
+    if name in names:
+        try:
+            cur.execute(call, args)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Session was reset under us (DISCARD ALL, pooler): prepare again next time
+            names.discard(name)
+            raise
+        return
+    # A prepared statement outlives a failed EXECUTE or rollback, so it is recorded up front
+    names.add(name)
+    cur.execute(f"PREPARE {name} AS {sql}; {call}", args)
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+REDIS_URL = os.environ.get("REDIS_URL")
+# Clients heartbeat about every 25 seconds; a user is online until one is missed for this long
+ONLINE_TTL = int(os.environ.get("PRESENCE_ONLINE_TTL", "60"))
+LAST_SEEN_TTL = 30 * 86400
+TYPING_TTL = 6
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def chat_key(kind, owner_id):
+    return f"{kind}:{owner_id}"
+
+
+class LocalStore:
+    """Per-process stand-in with the same expiry semantics, for tests and the single-process app server"""
+
+    def __init__(self):
+        self.seen = {}
+        self.typing = {}
+        self.lock = threading.Lock()
+        self.next_purge = time.time() + ONLINE_TTL
+
+    def _purge(self, now):
+        self.next_purge = now + ONLINE_TTL
+        for uid in [u for u, ts in self.seen.items() if now - ts > LAST_SEEN_TTL]:
+            del self.seen[uid]
+        for key in [k for k, users in self.typing.items() if max(users.values()) <= now]:
+            del self.typing[key]
+
+    def heartbeat(self, user_id):
+        now = time.time()
+        with self.lock:
+            self.seen[user_id] = now
+            if now >= self.next_purge:
+                self._purge(now)
+
+    def set_typing(self, key, user_id, typing):
+        now = time.time()
+        with self.lock:
+            users = self.typing.setdefault(key, {})
+            if typing:
+                users[user_id] = now + TYPING_TTL
+            else:
+                users.pop(user_id, None)
+                if not users:
+                    del self.typing[key]
+
+    def lookup(self, user_ids, keys):
+        now = time.time()
+        with self.lock:
+            seen = {uid: self.seen[uid] for uid in user_ids if uid in self.seen}
+            typing = {key: {uid for uid, until in self.typing.get(key, {}).items() if until > now} for key in keys}
+        return seen, typing
+
+
+class RedisStore:
+    """Shared store: one expiring key per user holding the last heartbeat, one sorted set per chat of
+    typing users scored by when their flag runs out"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def heartbeat(self, user_id):
+        self.client.set(f"presence:{user_id}", int(time.time()), ex=LAST_SEEN_TTL)
+
+    def set_typing(self, key, user_id, typing):
+        name = f"typing:{key}"
+        if not typing:
+            self.client.zrem(name, user_id)
+            return
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(name, {user_id: now + TYPING_TTL})
+        pipe.zremrangebyscore(name, "-inf", now)
+        pipe.expire(name, TYPING_TTL)
+        pipe.execute()
+
+    def lookup(self, user_ids, keys):
+        """Everything a list or history response needs in one round trip"""
+        user_ids, keys = list(user_ids), list(keys)
+        if not user_ids and not keys:
+            return {}, {}
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        if user_ids:
+            pipe.mget([f"presence:{uid}" for uid in user_ids])
+        for key in keys:
+            pipe.zrangebyscore(f"typing:{key}", now, "+inf")
+        replies = pipe.execute()
+        seen = {}
+        if user_ids:
+            seen = {uid: float(ts) for uid, ts in zip(user_ids, replies.pop(0)) if ts is not None}
+        typing = {key: {int(uid) for uid in members} for key, members in zip(keys, replies)}
+        return seen, typing
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if REDIS_URL:
+                    import redis
+                    _store = RedisStore(redis.Redis.from_url(REDIS_URL, socket_timeout=0.5))
+                else:
+                    _store = LocalStore()
+    return _store
+
+
+def store_errors():
+    """Exceptions that mean the store is unreachable rather than that the caller got something wrong"""
+    if REDIS_URL:
+        import redis
+        return (redis.RedisError, OSError)
+    return (OSError,)
+
+
+def is_online(seen, user_id, now=None):
+    ts = seen.get(user_id)
+    return ts is not None and (now or time.time()) - ts < ONLINE_TTL
@@ -0,0 +1,59 @@
+"""Memory and lookup latency of the hashtag prefix index: python bench_hashtags.py [tags] [lookups]"""
+import random
+import resource
+import sys
+import time
+import hashtag_index
+
+ALPHABET = "абвгдеёжзийклмнопрстуфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz0123456789_"
+
+
+def synthetic(n, seed=1):
+    """n distinct tags in byte order with Zipf-like counts and recent uses"""
+    rng = random.Random(seed)
+    letters = ALPHABET[:33] * 3 + ALPHABET[33:]
+    tags = set()
+    while len(tags) < n:
+        tags.add("".join(rng.choices(letters, k=rng.randint(3, 14))))
+    ordered = sorted(tags, key=str.encode)
+    del tags
+    for tag in ordered:
+        count = int(1 / (rng.random() + 1e-6))
+        yield tag, count, rng.randint(0, count) if rng.random() < 0.1 else 0
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    index = hashtag_index.HashtagIndex.from_rows(synthetic(n))
+    build_s = time.perf_counter() - started
+
+    rng = random.Random(2)
+    prefixes = []
+    for _ in range(lookups):
+        tag = index.keys[rng.randrange(len(index))].decode()
+        prefixes.append(tag[:rng.randint(1, min(4, len(tag)))])
+
+    for label in ("cold", "warm"):
+        timings = []
+        for prefix in prefixes:
+            t = time.perf_counter()
+            index.suggest(prefix, 10)
+            timings.append((time.perf_counter() - t) * 1e6)
+        timings.sort()
+        print(f"{label}: p50={percentile(timings, 0.5):.1f}us p99={percentile(timings, 0.99):.1f}us "
+              f"max={timings[-1]:.0f}us")
+
+    print(f"tags={len(index)} build={build_s:.1f}s index={index.nbytes() / 2 ** 20:.1f}MiB "
+          f"memo_entries={len(index.memo)} peak_rss_growth={(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024:.0f}MiB")
+
+
+if __name__ == "__main__":
+    main()
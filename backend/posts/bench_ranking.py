@@ -0,0 +1,45 @@
+"""Benchmark of ranked feed scoring: python bench_ranking.py [candidates] [runs]"""
+import sys
+import time
+import numpy as np
+import ranking
+
+BUDGET_MS = 50.0
+
+
+def synthetic(n, seed=1):
+    rng = np.random.default_rng(seed)
+    authors = rng.integers(1, 2000, n)
+    candidates = list(zip(
+        range(1, n + 1),
+        authors.tolist(),
+        rng.poisson(20, n).tolist(),
+        rng.uniform(0, 168, n).tolist(),
+        rng.poisson(3, n).tolist(),
+        rng.integers(0, 2, n).tolist(),
+    ))
+    liked = np.unique(rng.integers(1, 2000, 300))
+    affinity = list(zip(liked.tolist(), rng.integers(1, 50, len(liked)).tolist()))
+    return candidates, affinity
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else ranking.CANDIDATES
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    candidates, affinity = synthetic(n)
+    ranking.rank(candidates, affinity)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        ranking.rank(candidates, affinity)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p50 = timings[len(timings) // 2]
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"candidates={n} runs={runs} p50={p50:.2f}ms p99={p99:.2f}ms budget={BUDGET_MS:.0f}ms")
+    if p99 > BUDGET_MS:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Replica routing and batched reads shared by the functions that declare read actions (each deploys its
+own identical copy of this file).
+
+Read-only actions may be served by a replica that has replayed the caller's last write, and several of
+them can be combined into one batch request that runs inside a single read-only snapshot.
+"""
+import json
+import os
+import random
+import re
+import psycopg2
+
+REPLICA_URLS = [u.strip() for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+LSN = re.compile(r"^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$")
+MAX_BATCH = 20
+
+
+class Routing:
+    """One function's read actions, metrics and primary connection.
+
+    connect is called on every use, so the app server can swap the function's get_conn for its pool.
+    """
+
+    def __init__(self, function, read_actions, default_action, cors, connect):
+        self.function = function
+        self.read_actions = read_actions
+        self.default_action = default_action
+        self.cors = cors
+        self.connect = connect
+
+    def log_metric(self, name, **fields):
+        print(json.dumps({"metric": name, "function": self.function, **fields}))
+
+    def get_read_conn(self, min_lsn):
+        """Connection to a replica that has replayed the caller's last write (min_lsn), falling back to the primary"""
+        if not LSN.match(min_lsn or ""):
+            # A missing or garbled position only loses read-your-writes, never the request
+            min_lsn = None
+        for url in random.sample(REPLICA_URLS, len(REPLICA_URLS)):
+            try:
+                conn = psycopg2.connect(url, connect_timeout=2)
+            except psycopg2.OperationalError:
+                self.log_metric("db_route", target="replica", decision="unreachable")
+                continue
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn,
+                           EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+                """, (min_lsn or "0/0",))
+                caught_up, lag = cur.fetchone()
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+                self.log_metric("db_route", target="replica", decision="probe_failed")
+                continue
+            self.log_metric("db_route", target="replica", decision="served" if caught_up else "behind",
+                            lag_seconds=float(lag) if lag is not None else None)
+            if caught_up:
+                return conn
+            conn.close()
+        if REPLICA_URLS:
+            self.log_metric("db_route", target="primary", decision="fallback")
+        return self.connect()
+
+    def is_read_request(self, event):
+        if event.get("httpMethod", "GET") == "GET":
+            params = event.get("queryStringParameters") or {}
+            return params.get("action", self.default_action) in self.read_actions
+        body = json.loads(event.get("body") or "{}")
+        return body.get("action") == "batch"
+
+    def with_session_lsn(self, resp, conn):
+        """Tags a write response with the primary's WAL position so the client's next read can wait for it"""
+        cur = conn.cursor()
+        cur.execute("SELECT pg_current_wal_lsn()::text")
+        lsn = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+        return {**resp, "headers": {**resp["headers"], "X-Session-Lsn": lsn}}
+
+    def run_batch(self, conn, requests, route):
+        """Runs several read actions through route(event, conn) over one connection inside a single read-only snapshot"""
+        if not isinstance(requests, list):
+            return {"statusCode": 400, "headers": self.cors, "body": json.dumps({"error": "Некорректный запрос"})}
+        if len(requests) > MAX_BATCH:
+            return {"statusCode": 400, "headers": self.cors, "body": json.dumps({"error": "Слишком много запросов"})}
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        results = []
+        try:
+            for item in requests:
+                if not isinstance(item, dict) or not isinstance(item.get("params") or {}, dict):
+                    results.append({"status": 400, "body": {"error": "Некорректный запрос"}})
+                    continue
+                action = item.get("action", self.default_action)
+                if item.get("function", self.function) != self.function or action not in self.read_actions:
+                    results.append({"status": 400, "body": {"error": "Неизвестное действие"}})
+                    continue
+                sub_event = {"httpMethod": "GET", "queryStringParameters": {**(item.get("params") or {}), "action": action}}
+                try:
+                    resp = route(sub_event, conn)
+                except Exception as e:
+                    # A failed statement aborts the snapshot, so start a fresh one for the rest
+                    conn.rollback()
+                    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    self.log_metric("batch", action=action, decision="error", error=repr(e))
+                    results.append({"status": 500, "body": {"error": "Ошибка сервера"}})
+                    continue
+                results.append({"status": resp["statusCode"], "body": json.loads(resp["body"])})
+        finally:
+            cur.close()
+            conn.rollback()
+        return {"statusCode": 200, "headers": self.cors, "body": json.dumps({"results": results})}
@@ -0,0 +1,195 @@
+import bisect
+import math
+import os
+import threading
+import time
+from array import array
+
+TTL = int(os.environ.get("HASHTAG_INDEX_TTL", "600"))
+# Tags added since the last load before a full reload is forced
+MAX_OVERLAY = 10000
+MAX_K = 20
+# Prefixes matching more tags than this keep their top-K after the first lookup
+MEMO_MIN = 4096
+MEMO_MAX = 50000
+RECENT_DAYS = 30
+W_RECENT = 1.0
+W_TOTAL = 0.3
+
+_index = None
+# Tags recorded while a rebuild runs, replayed onto the new index; None when no build is running
+_pending = None
+_lock = threading.Lock()
+
+
+def weight(count, recent):
+    """Uses in the last RECENT_DAYS dominate; the all-time count only breaks ties among quiet tags"""
+    return W_RECENT * recent + W_TOTAL * math.log1p(count)
+
+
+class _Keys:
+    """Read-only sequence view of the packed tags for bisect"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]]
+
+
+class HashtagIndex:
+    """Tags sorted by their UTF-8 bytes and packed into one blob, with parallel offsets and weights.
+
+    Every completion of a prefix is a contiguous range of the sorted tags, found by two binary searches.
+    """
+
+    def __init__(self, blob, offsets, weights):
+        self.blob = blob
+        self.offsets = offsets
+        self.weights = weights
+        self.keys = _Keys(blob, offsets)
+        self.memo = {}
+        # tag bytes -> weight added since the load; sorted copy of its keys for range lookups
+        self.added = {}
+        self.added_keys = []
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """rows: (tag, count, recent uses) ordered by tag bytes, as ORDER BY tag COLLATE "C" returns them"""
+        import numpy as np
+        blob = bytearray()
+        offsets = array("Q", [0])
+        weights = array("f")
+        for tag, count, recent in rows:
+            blob += tag.encode()
+            offsets.append(len(blob))
+            weights.append(weight(count, recent))
+        if len(blob) < 2 ** 32:
+            offsets = array("I", offsets)
+        return cls(bytes(blob), offsets, np.frombuffer(weights, dtype=np.float32))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nbytes(self):
+        return len(self.blob) + self.offsets.itemsize * len(self.offsets) + self.weights.nbytes
+
+    def stale(self):
+        return time.monotonic() - self.loaded_at > TTL or len(self.added) > MAX_OVERLAY
+
+    def _range(self, keys, prefix):
+        # 0xff never occurs in UTF-8, so prefix + 0xff sorts after every tag starting with prefix
+        return bisect.bisect_left(keys, prefix), bisect.bisect_left(keys, prefix + b"\xff")
+
+    def _top(self, lo, hi):
+        """Up to MAX_K (weight, position) pairs of the range, heaviest first"""
+        import numpy as np
+        if hi - lo > MAX_K:
+            picked = np.argpartition(-self.weights[lo:hi], MAX_K)[:MAX_K] + lo
+        else:
+            picked = range(lo, hi)
+        return sorted(((float(self.weights[i]), int(i)) for i in picked), key=lambda p: (-p[0], p[1]))
+
+    def suggest(self, prefix, k=10):
+        key = prefix.encode()
+        lo, hi = self._range(self.keys, key)
+        if hi - lo > MEMO_MIN:
+            top = self.memo.get(key)
+            if top is None:
+                if len(self.memo) >= MEMO_MAX:
+                    self.memo.clear()
+                top = self.memo[key] = self._top(lo, hi)
+        else:
+            top = self._top(lo, hi)
+        scores = {self.keys[i]: w for w, i in top}
+        # Tags used since the load: boosts to indexed tags and brand new ones
+        a_lo, a_hi = self._range(self.added_keys, key)
+        for tag in self.added_keys[a_lo:a_hi]:
+            base = scores.get(tag)
+            if base is None:
+                i = bisect.bisect_left(self.keys, tag)
+                base = float(self.weights[i]) if i < len(self.keys) and self.keys[i] == tag else 0.0
+            scores[tag] = base + self.added[tag]
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [tag.decode() for tag, _ in best]
+
+    def record(self, tags):
+        for tag in tags:
+            key = tag.encode()
+            if key not in self.added:
+                bisect.insort(self.added_keys, key)
+                self.added[key] = 0.0
+            self.added[key] += W_RECENT
+
+
+def load(cur, schema):
+    # A server-side cursor, so the whole table is never buffered in the client at once
+    rows = cur.connection.cursor(name="hashtag_index_load")
+    rows.itersize = 50000
+    rows.execute(f"""
+        SELECT h.tag, h.count, COALESCE(r.n, 0)
+        FROM {schema}.hashtags h
+        LEFT JOIN (
+            SELECT ph.hashtag_id, COUNT(*) AS n
+            FROM {schema}.post_hashtags ph JOIN {schema}.posts p ON p.id = ph.post_id
+            WHERE p.created_at > NOW() - make_interval(days => %s) AND p.deleted_at IS NULL
+            GROUP BY ph.hashtag_id
+        ) r ON r.hashtag_id = h.id
+        WHERE h.count > 0
+        ORDER BY h.tag COLLATE "C"
+    """, (RECENT_DAYS,))
+    try:
+        return HashtagIndex.from_rows(rows)
+    finally:
+        rows.close()
+
+
+def refresh(connect, schema):
+    """Starts a background rebuild on a connection of its own, unless one is already running"""
+    global _pending
+    with _lock:
+        if _pending is not None:
+            return
+        _pending = []
+    threading.Thread(target=_rebuild, args=(connect, schema), daemon=True).start()
+
+
+def _rebuild(connect, schema):
+    global _index, _pending
+    fresh = None
+    try:
+        conn = connect()
+        try:
+            fresh = load(conn.cursor(), schema)
+        finally:
+            conn.close()
+    except Exception as e:
+        # The old index keeps serving; the next lookup of a stale index retries
+        print(f"hashtag index rebuild failed: {e}")
+    finally:
+        with _lock:
+            if fresh is not None:
+                # Tags recorded just before the snapshot are counted twice, which only nudges their weight
+                fresh.record(_pending)
+                _index = fresh
+            _pending = None
+
+
+def get_index(connect, schema):
+    """Process-wide index, or None until the first build finishes; a stale one keeps serving while it is rebuilt"""
+    if _index is None or _index.stale():
+        refresh(connect, schema)
+    return _index
+
+
+def record(tags):
+    with _lock:
+        if _pending is not None:
+            _pending.extend(tags)
+    if _index is not None and tags:
+        _index.record(tags)
@@ -1,24 +1,47 @@
 import json
 import os
 import base64
-import boto3
 import psycopg2
 import datetime
 import re
+from concurrent.futures import ThreadPoolExecutor
+import hashtag_index
+import ranking
+import admission
+import db_routing
 
 SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
+FUNCTION = "posts"
+# Read-only GET actions: may be served by a replica and combined into one batch request
+READ_ACTIONS = {"feed", "user_posts", "hashtag", "trending", "hashtag_suggest"}
 CORS = {
     "Access-Control-Allow-Origin": "*",
     "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Allow-Headers": "Content-Type, X-Session-Lsn",
+    "Access-Control-Expose-Headers": "X-Session-Lsn",
 }
+# Media uploads run here while create inserts the post row
+_uploads = ThreadPoolExecutor(max_workers=4)
 
 
 def get_conn():
     return psycopg2.connect(os.environ["DATABASE_URL"])
 
 
+routing = db_routing.Routing(FUNCTION, READ_ACTIONS, "feed", CORS, lambda: get_conn())
+log_metric = routing.log_metric
+# A module attribute so the app server can route a batch's reads to its shared connection instead
+get_read_conn = routing.get_read_conn
+
+
+if os.environ.get("DATABASE_URL"):
+    # Warm start: build the hashtag index in the background before the first hashtag_suggest needs it
+    hashtag_index.refresh(lambda: get_conn(), SCHEMA)
+
+
 def get_s3():
+    # Imported lazily: only create with media needs the bucket
+    import boto3
     return boto3.client(
         "s3",
         endpoint_url="https://bucket.poehali.dev",
@@ -40,17 +63,94 @@ def time_ago(dt):
     return f"{s // 86400} дн назад"
 
 
+def param_int(params, name, default):
+    """Integer query parameter, or the default when it is missing or not a number"""
+    try:
+        return int(params.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
 def extract_hashtags(text):
     return [tag.lower() for tag in re.findall(r'#(\w+)', text)]
 
 
+def ranked_post_ids(cur, user_id):
+    """Engagement-ranked candidate ids for the user, cached for a short TTL"""
+    post_ids = ranking.cached(user_id)
+    if post_ids is not None:
+        return post_ids
+    cur.execute(f"""
+        WITH followed AS (
+            SELECT following_id AS user_id FROM {SCHEMA}.follows WHERE follower_id = %s
+        ), candidates AS (
+            (SELECT p.id FROM {SCHEMA}.posts p JOIN followed f ON f.user_id = p.user_id
+             WHERE p.created_at > NOW() - INTERVAL '7 days' AND p.deleted_at IS NULL
+             ORDER BY p.created_at DESC LIMIT 3000)
+            UNION
+            (SELECT ph.post_id FROM {SCHEMA}.post_hashtags ph
+             JOIN (SELECT id FROM {SCHEMA}.hashtags ORDER BY count DESC LIMIT 10) h ON h.id = ph.hashtag_id
+             JOIN {SCHEMA}.posts p ON p.id = ph.post_id
+             WHERE p.created_at > NOW() - INTERVAL '3 days' AND p.deleted_at IS NULL
+             ORDER BY p.created_at DESC LIMIT 1000)
+            UNION
+            (SELECT id FROM {SCHEMA}.posts WHERE created_at > NOW() - INTERVAL '3 days' AND deleted_at IS NULL
+             ORDER BY likes_count DESC LIMIT 1000)
+            UNION
+            (SELECT id FROM {SCHEMA}.posts WHERE deleted_at IS NULL ORDER BY created_at DESC LIMIT 500)
+        )
+        SELECT p.id, p.user_id, p.likes_count,
+               EXTRACT(EPOCH FROM NOW() - p.created_at) / 3600.0,
+               COALESCE(cc.n, 0),
+               (p.user_id IN (SELECT user_id FROM followed))::int
+        FROM candidates c
+        JOIN {SCHEMA}.posts p ON p.id = c.id
+        LEFT JOIN (
+            SELECT post_id, COUNT(*) AS n FROM {SCHEMA}.comments
+            WHERE post_id IN (SELECT id FROM candidates) GROUP BY post_id
+        ) cc ON cc.post_id = p.id
+        -- The sources can add up to more than CANDIDATES; decay scores the oldest lowest, so they are cut
+        ORDER BY p.created_at DESC
+        LIMIT {ranking.CANDIDATES}
+    """, (user_id,))
+    candidates = cur.fetchall()
+    # Author affinity: how often the user liked each author among their recent likes
+    cur.execute(f"""
+        SELECT p.user_id, COUNT(*)
+        FROM (SELECT post_id FROM {SCHEMA}.post_likes WHERE user_id = %s ORDER BY post_id DESC LIMIT 1000) pl
+        JOIN {SCHEMA}.posts p ON p.id = pl.post_id
+        GROUP BY p.user_id ORDER BY p.user_id
+    """, (user_id,))
+    post_ids = ranking.rank(candidates, cur.fetchall())
+    ranking.store(user_id, post_ids)
+    return post_ids
+
+
+@admission.guard(FUNCTION, CORS, reads=READ_ACTIONS | {"batch"}, default_action="feed")
 def handler(event: dict, context) -> dict:
     """Лента постов Eclipse: получение, создание, лайки, комментарии, удаление, медиа, хештеги"""
     if event.get("httpMethod") == "OPTIONS":
         return {"statusCode": 200, "headers": CORS, "body": ""}
 
+    read = routing.is_read_request(event)
+    if read and db_routing.REPLICA_URLS:
+        headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+        params = event.get("queryStringParameters") or {}
+        conn = get_read_conn(headers.get("x-session-lsn") or params.get("min_lsn"))
+    else:
+        conn = get_conn()
+    try:
+        resp = route(event, conn)
+        if db_routing.REPLICA_URLS and not read and resp["statusCode"] == 200:
+            log_metric("db_route", target="primary", decision="write")
+            resp = routing.with_session_lsn(resp, conn)
+        return resp
+    finally:
+        conn.close()
+
+
+def route(event: dict, conn) -> dict:
     method = event.get("httpMethod", "GET")
-    conn = get_conn()
     cur = conn.cursor()
 
     try:
@@ -60,17 +160,33 @@ def handler(event: dict, context) -> dict:
             action = params.get("action", "feed")
 
             if action == "feed":
-                cur.execute(f"""
-                    SELECT p.id, p.text, p.likes_count, p.created_at, p.media_url, p.media_type,
-                           u.id, u.name, u.handle, u.avatar,
-                           CASE WHEN pl.user_id IS NOT NULL THEN true ELSE false END as liked
-                    FROM {SCHEMA}.posts p
-                    JOIN {SCHEMA}.users u ON u.id = p.user_id
-                    LEFT JOIN {SCHEMA}.post_likes pl ON pl.post_id = p.id AND pl.user_id = %s
-                    ORDER BY p.created_at DESC
-                    LIMIT 50
-                """, (user_id,))
-                posts_rows = cur.fetchall()
+                if params.get("mode") == "ranked":
+                    offset = max(param_int(params, "offset", 0), 0)
+                    page_ids = ranked_post_ids(cur, user_id)[offset:offset + 50]
+                    cur.execute(f"""
+                        SELECT p.id, p.text, p.likes_count, p.created_at, p.media_url, p.media_type,
+                               u.id, u.name, u.handle, u.avatar,
+                               CASE WHEN pl.user_id IS NOT NULL THEN true ELSE false END as liked
+                        FROM {SCHEMA}.posts p
+                        JOIN {SCHEMA}.users u ON u.id = p.user_id
+                        LEFT JOIN {SCHEMA}.post_likes pl ON pl.post_id = p.id AND pl.user_id = %s
+                        WHERE p.id = ANY(%s) AND p.deleted_at IS NULL
+                    """, (user_id, page_ids))
+                    by_id = {r[0]: r for r in cur.fetchall()}
+                    posts_rows = [by_id[pid] for pid in page_ids if pid in by_id]
+                else:
+                    cur.execute(f"""
+                        SELECT p.id, p.text, p.likes_count, p.created_at, p.media_url, p.media_type,
+                               u.id, u.name, u.handle, u.avatar,
+                               CASE WHEN pl.user_id IS NOT NULL THEN true ELSE false END as liked
+                        FROM {SCHEMA}.posts p
+                        JOIN {SCHEMA}.users u ON u.id = p.user_id
+                        LEFT JOIN {SCHEMA}.post_likes pl ON pl.post_id = p.id AND pl.user_id = %s
+                        WHERE p.deleted_at IS NULL
+                        ORDER BY p.created_at DESC
+                        LIMIT 50
+                    """, (user_id,))
+                    posts_rows = cur.fetchall()
 
                 post_ids = [r[0] for r in posts_rows]
                 comments_map = {}
@@ -121,7 +237,7 @@ def handler(event: dict, context) -> dict:
                     FROM {SCHEMA}.posts p
                     JOIN {SCHEMA}.users u ON u.id = p.user_id
                     LEFT JOIN {SCHEMA}.post_likes pl ON pl.post_id = p.id AND pl.user_id = {user_id}
-                    WHERE p.user_id = %s
+                    WHERE p.user_id = %s AND p.deleted_at IS NULL
                     ORDER BY p.created_at DESC
                     LIMIT 50
                 """, (target_id,))
@@ -147,7 +263,7 @@ def handler(event: dict, context) -> dict:
                     JOIN {SCHEMA}.post_hashtags ph ON ph.post_id = p.id
                     JOIN {SCHEMA}.hashtags h ON h.id = ph.hashtag_id
                     LEFT JOIN {SCHEMA}.post_likes pl ON pl.post_id = p.id AND pl.user_id = {user_id}
-                    WHERE h.tag = %s
+                    WHERE h.tag = %s AND p.deleted_at IS NULL
                     ORDER BY p.created_at DESC
                     LIMIT 50
                 """, (tag,))
@@ -167,10 +283,21 @@ def handler(event: dict, context) -> dict:
                 tags = [{"tag": r[0], "count": r[1]} for r in cur.fetchall()]
                 return {"statusCode": 200, "headers": CORS, "body": json.dumps({"tags": tags})}
 
+            elif action == "hashtag_suggest":
+                prefix = params.get("q", "").lower().lstrip("#")
+                k = max(1, min(param_int(params, "limit", 10), hashtag_index.MAX_K))
+                # Until the first build of this instance finishes there is nothing to suggest from
+                index = hashtag_index.get_index(get_conn, SCHEMA) if prefix else None
+                tags = index.suggest(prefix, k) if index is not None else []
+                return {"statusCode": 200, "headers": CORS, "body": json.dumps({"tags": [{"tag": t} for t in tags]})}
+
         body = json.loads(event.get("body") or "{}")
         action = body.get("action")
 
-        if action == "create":
+        if action == "batch":
+            return routing.run_batch(conn, body.get("requests") or [], route)
+
+        elif action == "create":
             user_id = body["user_id"]
             text = body["text"].strip()
             if not text:
@@ -178,6 +305,7 @@ def handler(event: dict, context) -> dict:
 
             media_url = None
             media_type = None
+            upload = None
 
             if body.get("media_data") and body.get("media_type"):
                 s3 = get_s3()
@@ -185,7 +313,7 @@ def handler(event: dict, context) -> dict:
                 media_type = body["media_type"]
                 ext = "jpg" if "image" in media_type else "mp4"
                 key = f"posts/{user_id}/{datetime.datetime.now().timestamp()}.{ext}"
-                s3.put_object(Bucket="files", Key=key, Body=raw, ContentType=media_type)
+                upload = _uploads.submit(s3.put_object, Bucket="files", Key=key, Body=raw, ContentType=media_type)
                 ak = os.environ["AWS_ACCESS_KEY_ID"]
                 media_url = f"https://cdn.poehali.dev/projects/{ak}/bucket/{key}"
 
@@ -195,6 +323,8 @@ def handler(event: dict, context) -> dict:
             )
             row = cur.fetchone()
             post_id = row[0]
+            if upload:
+                upload.result()
             conn.commit()
 
             # Process hashtags
@@ -211,6 +341,7 @@ def handler(event: dict, context) -> dict:
                 cur.execute(f"INSERT INTO {SCHEMA}.post_hashtags (post_id, hashtag_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (post_id, hashtag_id))
             if tags:
                 conn.commit()
+                hashtag_index.record(tags)
 
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"id": post_id, "media_url": media_url})}
 
@@ -226,7 +357,8 @@ def handler(event: dict, context) -> dict:
                 UPDATE {SCHEMA}.hashtags h SET count = GREATEST(0, count-1)
                 FROM {SCHEMA}.post_hashtags ph WHERE ph.hashtag_id=h.id AND ph.post_id=%s
             """, (post_id,))
-            cur.execute(f"UPDATE {SCHEMA}.posts SET text='[удалено]', media_url=NULL WHERE id=%s", (post_id,))
+            # The row and its dependents are removed later by maintenance compaction
+            cur.execute(f"UPDATE {SCHEMA}.posts SET text='[удалено]', media_url=NULL, deleted_at=NOW() WHERE id=%s", (post_id,))
             conn.commit()
             return {"statusCode": 200, "headers": CORS, "body": json.dumps({"ok": True})}
 
@@ -305,4 +437,3 @@ def handler(event: dict, context) -> dict:
 
     finally:
         cur.close()
-        conn.close()
@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CANDIDATES = 5000
+HALF_LIFE_HOURS = float(os.environ.get("FEED_HALF_LIFE_HOURS", "18"))
+CACHE_TTL = int(os.environ.get("FEED_CACHE_TTL", "60"))
+CACHE_SIZE = 10000
+W_VELOCITY = 1.0
+W_COMMENTS = 0.6
+W_AFFINITY = 0.8
+W_FOLLOWED = 0.5
+# Keeps fresh posts without any engagement ordered by recency
+BASELINE = 0.1
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def score(likes, comments, age_hours, authors, followed, affinity_authors, affinity_counts):
+    """Scores every candidate in one vectorized pass; affinity_authors must be sorted"""
+    import numpy as np  # only the ranked feed mode needs it
+    velocity = likes / (age_hours + 2.0)
+    affinity = np.zeros_like(likes)
+    if len(affinity_authors):
+        idx = np.minimum(np.searchsorted(affinity_authors, authors), len(affinity_authors) - 1)
+        hit = affinity_authors[idx] == authors
+        affinity[hit] = affinity_counts[idx[hit]]
+    decay = np.exp2(-age_hours / HALF_LIFE_HOURS)
+    return (W_VELOCITY * np.log1p(velocity)
+            + W_COMMENTS * np.log1p(comments)
+            + W_AFFINITY * np.log1p(affinity)
+            + W_FOLLOWED * followed
+            + BASELINE) * decay
+
+
+def rank(candidates, affinity):
+    """Post ids ordered by score.
+
+    candidates: rows of (post_id, author_id, likes, age_hours, comments, followed)
+    affinity: rows of (author_id, likes given by the viewer), sorted by author_id
+    """
+    if not candidates:
+        return []
+    import numpy as np
+    c = np.array(candidates, dtype=np.float64)
+    a = np.array(affinity, dtype=np.float64).reshape(-1, 2)
+    scores = score(c[:, 2], c[:, 4], c[:, 3], c[:, 1], c[:, 5], a[:, 0], a[:, 1])
+    order = np.argsort(-scores, kind="stable")
+    return c[order, 0].astype(np.int64).tolist()
+
+
+def cached(user_id):
+    with _cache_lock:
+        entry = _cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def store(user_id, post_ids):
+    with _cache_lock:
+        _cache[user_id] = (time.monotonic() + CACHE_TTL, post_ids)
+        _cache.move_to_end(user_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
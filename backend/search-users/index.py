@@ -1,6 +1,7 @@
 import json
 import os
 import psycopg2
+import admission
 
 SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
 CORS = {
@@ -14,6 +15,7 @@ def get_conn():
     return psycopg2.connect(os.environ["DATABASE_URL"])
 
 
+@admission.guard("search-users", CORS, reads={"search"}, default_action="search")
 def handler(event: dict, context) -> dict:
     """Поиск пользователей по имени или никнейму"""
     if event.get("httpMethod") == "OPTIONS":
@@ -0,0 +1,222 @@
+"""Single-process WSGI server hosting every function from func2url.json.
+
+    python app.py [port]        # or any WSGI server: gunicorn --threads 8 app:app
+
+Requests to /<function>/... are turned into the same event dict the cloud
+runtime passes to handler(event, context). All handlers share one pool of
+primary connections, and their module-level caches live as long as the process.
+POST /batch runs read actions of several functions in one snapshot.
+"""
+import importlib.util
+import json
+import os
+import sys
+import threading
+from http import HTTPStatus
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+from wsgiref.simple_server import WSGIServer, make_server
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POOL_SIZE = int(os.environ.get("APP_POOL_SIZE", "10"))
+MAX_BATCH = 20
+# Read actions that can join a cross-function batch, for functions that do not declare READ_ACTIONS
+EXTRA_READ_ACTIONS = {"update-profile": {"get"}, "search-users": {"search"}}
+# Functions that take their action from the JSON body rather than the query string
+BODY_ACTIONS = {"update-profile"}
+CORS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+_local = threading.local()
+_mount_lock = threading.Lock()
+_pool = None
+_pool_slots = threading.BoundedSemaphore(POOL_SIZE)
+_functions = {}
+
+
+def function_names():
+    with open(os.path.join(BACKEND, "func2url.json")) as f:
+        return sorted(json.load(f))
+
+
+def load_function(name):
+    """Imports backend/<name>/index.py with its sibling modules isolated from other functions'.
+
+    Siblings are unreachable by name once this returns, so index.py must import them at module level.
+    """
+    directory = os.path.join(BACKEND, name)
+    siblings = [f[:-3] for f in os.listdir(directory) if f.endswith(".py") and f != "index.py"]
+    for mod in siblings:
+        sys.modules.pop(mod, None)
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f"fn_{name.replace('-', '_')}", os.path.join(directory, "index.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        for mod in siblings:
+            sys.modules.pop(mod, None)
+    return module
+
+
+class PooledConnection:
+    """Pool checkout that returns the connection on close() instead of disconnecting"""
+
+    def __init__(self):
+        _pool_slots.acquire()
+        self._conn = _pool.getconn()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        _pool.putconn(conn, close=broken)
+        _pool_slots.release()
+
+
+class BorrowedConnection:
+    """The batch's shared connection as seen by one handler: close() is a no-op"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        pass
+
+
+def shared_conn(*args):
+    batch_conn = getattr(_local, "batch_conn", None)
+    if batch_conn is not None:
+        return BorrowedConnection(batch_conn)
+    return PooledConnection()
+
+
+def mount():
+    global _pool
+    if _functions:
+        return
+    import psycopg2.pool
+    _pool = psycopg2.pool.ThreadedConnectionPool(1, POOL_SIZE, os.environ["DATABASE_URL"])
+    loaded = {}
+    for name in function_names():
+        module = load_function(name)
+        module.get_conn = shared_conn
+        if hasattr(module, "get_read_conn"):
+            replica_conn = module.get_read_conn
+            module.get_read_conn = lambda min_lsn, _orig=replica_conn: (
+                shared_conn() if getattr(_local, "batch_conn", None) is not None else _orig(min_lsn))
+        loaded[name] = module
+    _functions.update(loaded)
+
+
+def batch_event(name, action, params):
+    if name in BODY_ACTIONS:
+        return {"httpMethod": "POST", "queryStringParameters": {}, "body": json.dumps({**params, "action": action})}
+    query = {**params, "action": action} if action else dict(params)
+    return {"httpMethod": "GET", "queryStringParameters": query}
+
+
+def run_batch(requests):
+    """Read actions of any functions over one pooled connection inside a single read-only snapshot"""
+    if not isinstance(requests, list):
+        return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Некорректный запрос"})}
+    if len(requests) > MAX_BATCH:
+        return {"statusCode": 400, "headers": CORS, "body": json.dumps({"error": "Слишком много запросов"})}
+    conn = PooledConnection()
+    cur = conn.cursor()
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+    _local.batch_conn = conn._conn
+    results = []
+    try:
+        for item in requests:
+            if not isinstance(item, dict) or not isinstance(item.get("params") or {}, dict):
+                results.append({"status": 400, "body": {"error": "Некорректный запрос"}})
+                continue
+            name = item.get("function")
+            action = item.get("action")
+            module = _functions.get(name)
+            allowed = getattr(module, "READ_ACTIONS", set()) | EXTRA_READ_ACTIONS.get(name, set())
+            if module is None or action not in allowed:
+                results.append({"status": 400, "body": {"error": "Неизвестное действие"}})
+                continue
+            try:
+                resp = module.handler(batch_event(name, action, item.get("params") or {}), None)
+            except Exception as e:
+                conn.rollback()
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                print(json.dumps({"metric": "batch", "function": name, "action": action, "decision": "error",
+                                  "error": repr(e)}))
+                results.append({"status": 500, "body": {"error": "Ошибка сервера"}})
+                continue
+            results.append({"status": resp["statusCode"], "body": json.loads(resp["body"] or "null")})
+    finally:
+        _local.batch_conn = None
+        cur.close()
+        conn.close()
+    return {"statusCode": 200, "headers": CORS, "body": json.dumps({"results": results})}
+
+
+def to_event(environ):
+    length = int(environ.get("CONTENT_LENGTH") or 0)
+    body = environ["wsgi.input"].read(length).decode() if length else None
+    headers = {k[5:].replace("_", "-").title(): v for k, v in environ.items() if k.startswith("HTTP_")}
+    if environ.get("CONTENT_TYPE"):
+        headers["Content-Type"] = environ["CONTENT_TYPE"]
+    return {
+        "httpMethod": environ["REQUEST_METHOD"],
+        "queryStringParameters": dict(parse_qsl(environ.get("QUERY_STRING", ""))),
+        "headers": headers,
+        "body": body,
+        "requestContext": {"identity": {"sourceIp": environ.get("REMOTE_ADDR", "")}},
+    }
+
+
+def app(environ, start_response):
+    if not _functions:
+        with _mount_lock:
+            mount()
+    name = environ.get("PATH_INFO", "/").strip("/").split("/")[0]
+    event = to_event(environ)
+    if name == "batch" and event["httpMethod"] == "POST":
+        resp = run_batch(json.loads(event["body"] or "{}").get("requests") or [])
+    elif name == "batch" and event["httpMethod"] == "OPTIONS":
+        resp = {"statusCode": 200, "headers": CORS, "body": ""}
+    elif name in _functions:
+        resp = _functions[name].handler(event, None)
+    else:
+        resp = {"statusCode": 404, "headers": CORS, "body": json.dumps({"error": "Не найдено"})}
+    status = HTTPStatus(resp["statusCode"])
+    body = (resp.get("body") or "").encode()
+    headers = [(k, str(v)) for k, v in (resp.get("headers") or {}).items()]
+    headers.append(("Content-Length", str(len(body))))
+    if not any(k.lower() == "content-type" for k, _ in headers):
+        headers.append(("Content-Type", "application/json"))
+    start_response(f"{status.value} {status.phrase}", headers)
+    return [body]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    mount()
+    print(f"Serving {', '.join(_functions)} on :{port}")
+    make_server("", port, app, server_class=ThreadingWSGIServer).serve_forever()
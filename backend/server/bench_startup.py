@@ -0,0 +1,61 @@
+"""Cold-start benchmark: python bench_startup.py [runs]
+
+Each run loads every function in a fresh interpreter and reports how long the
+import of index.py took and how long the first request took. Without
+DATABASE_URL the first request is an OPTIONS preflight. With DATABASE_URL it is
+the first case from the function's tests.json.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import app
+
+CHILD = """
+import json, os, sys, time
+sys.path.insert(0, {server!r})
+import app
+started = time.perf_counter()
+module = app.load_function({name!r})
+imported = time.perf_counter()
+module.handler({event!r}, None)
+done = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "first_request_ms": (done - imported) * 1000,
+                  "boto3": "boto3" in sys.modules, "numpy": "numpy" in sys.modules}}))
+"""
+
+
+def first_event(name):
+    if not os.environ.get("DATABASE_URL"):
+        return {"httpMethod": "OPTIONS"}
+    with open(os.path.join(app.BACKEND, name, "tests.json")) as f:
+        test = json.load(f)["tests"][0]
+    path, _, query = test["path"].partition("?")
+    params = dict(p.split("=", 1) for p in query.split("&") if p)
+    body = json.dumps(test["body"]) if "body" in test else None
+    return {"httpMethod": test["method"], "queryStringParameters": params, "body": body, "headers": {}}
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    server = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'function':<16}{'import ms':>12}{'first req ms':>14}  lazy modules loaded")
+    for name in app.function_names():
+        code = CHILD.format(server=server, name=name, event=first_event(name))
+        samples = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+            samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        loaded = [m for m in ("boto3", "numpy") if samples[-1][m]] or ["-"]
+        print(f"{name:<16}{median([s['import_ms'] for s in samples]):>12.1f}"
+              f"{median([s['first_request_ms'] for s in samples]):>14.1f}  {', '.join(loaded)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import json
 import os
 import hashlib
 import psycopg2
+import admission
 
 SCHEMA = os.environ.get("MAIN_DB_SCHEMA", "public")
 CORS = {
@@ -19,6 +20,7 @@ def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
 
+@admission.guard("update-profile", CORS, reads={"get"})
 def handler(event: dict, context) -> dict:
     """Обновление профиля пользователя Eclipse"""
     if event.get("httpMethod") == "OPTIONS":
@@ -0,0 +1,39 @@
+-- Per-member read watermarks: everything with id <= last_read_message_id is read
+CREATE TABLE IF NOT EXISTS chat_read_marks (
+  chat_id INTEGER NOT NULL REFERENCES chats(id),
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  last_read_message_id INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(chat_id, user_id)
+) WITH (fillfactor = 70);
+
+CREATE TABLE IF NOT EXISTS group_read_marks (
+  group_id INTEGER NOT NULL REFERENCES group_chats(id),
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  last_read_message_id INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(group_id, user_id)
+) WITH (fillfactor = 70);
+
+-- Unread counts are range scans past the watermark
+CREATE INDEX IF NOT EXISTS chat_messages_chat_id_id_idx ON chat_messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS group_messages_group_id_id_idx ON group_messages(group_id, id);
+
+-- Backfill DM watermarks from is_read: just below the first unread message from the partner
+INSERT INTO chat_read_marks (chat_id, user_id, last_read_message_id)
+SELECT c.id, p.user_id,
+       COALESCE(
+         (SELECT MIN(cm.id) - 1 FROM chat_messages cm
+          WHERE cm.chat_id = c.id AND cm.sender_id != p.user_id AND cm.is_read = FALSE),
+         (SELECT MAX(cm.id) FROM chat_messages cm WHERE cm.chat_id = c.id),
+         0)
+FROM chats c
+CROSS JOIN LATERAL (VALUES (c.user1_id), (c.user2_id)) AS p(user_id)
+ON CONFLICT DO NOTHING;
+
+-- Groups had no read state: start every member at the latest message
+INSERT INTO group_read_marks (group_id, user_id, last_read_message_id)
+SELECT gcm.group_id, gcm.user_id,
+       COALESCE((SELECT MAX(gm.id) FROM group_messages gm WHERE gm.group_id = gcm.group_id), 0)
+FROM group_chat_members gcm
+ON CONFLICT DO NOTHING;
+
+ALTER TABLE chat_messages DROP COLUMN IF EXISTS is_read;
@@ -0,0 +1,130 @@
+-- Monthly range partitions for the unbounded message/notification tables.
+-- There is no DEFAULT partition (it would disable ordered partition scans), so
+-- the maintenance function must keep creating partitions ahead of time.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent REGCLASS, months_ahead INTEGER DEFAULT 3, since TIMESTAMPTZ DEFAULT NOW())
+RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+  nsp TEXT;
+  rel TEXT;
+  part TEXT;
+  month_start TIMESTAMP := date_trunc('month', since AT TIME ZONE 'UTC');
+  last_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC') + make_interval(months => months_ahead);
+  created INTEGER := 0;
+BEGIN
+  SELECT n.nspname, c.relname INTO nsp, rel
+  FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+  WHERE c.oid = parent;
+
+  WHILE month_start <= last_month LOOP
+    part := format('%s_p%s', rel, to_char(month_start, 'YYYY_MM'));
+    IF to_regclass(format('%I.%I', nsp, part)) IS NULL THEN
+      EXECUTE format('CREATE TABLE %I.%I PARTITION OF %I.%I FOR VALUES FROM (%L) TO (%L)',
+                     nsp, part, nsp, rel,
+                     month_start AT TIME ZONE 'UTC',
+                     (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC');
+      created := created + 1;
+    END IF;
+    month_start := month_start + INTERVAL '1 month';
+  END LOOP;
+  RETURN created;
+END $$;
+
+-- chat_messages
+DROP INDEX IF EXISTS chat_messages_chat_id_id_idx;
+ALTER TABLE chat_messages RENAME TO chat_messages_legacy;
+ALTER TABLE chat_messages_legacy RENAME CONSTRAINT chat_messages_pkey TO chat_messages_legacy_pkey;
+ALTER SEQUENCE chat_messages_id_seq OWNED BY NONE;
+
+CREATE TABLE chat_messages (
+  id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+  chat_id INTEGER NOT NULL REFERENCES chats(id),
+  sender_id INTEGER NOT NULL REFERENCES users(id),
+  text TEXT NOT NULL DEFAULT '',
+  msg_type VARCHAR(20) NOT NULL DEFAULT 'text',
+  file_url TEXT DEFAULT NULL,
+  file_name TEXT DEFAULT NULL,
+  duration INTEGER DEFAULT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX chat_messages_chat_id_created_idx ON chat_messages(chat_id, created_at, id);
+CREATE INDEX chat_messages_chat_id_id_idx ON chat_messages(chat_id, id);
+
+SELECT ensure_monthly_partitions('chat_messages', 3, (SELECT COALESCE(MIN(created_at), NOW()) FROM chat_messages_legacy));
+
+INSERT INTO chat_messages (id, chat_id, sender_id, text, msg_type, file_url, file_name, duration, created_at)
+SELECT id, chat_id, sender_id, text, msg_type, file_url, file_name, duration, COALESCE(created_at, NOW())
+FROM chat_messages_legacy;
+
+ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id;
+DROP TABLE chat_messages_legacy;
+
+-- group_messages
+DROP INDEX IF EXISTS group_messages_group_id_id_idx;
+ALTER TABLE group_messages RENAME TO group_messages_legacy;
+ALTER TABLE group_messages_legacy RENAME CONSTRAINT group_messages_pkey TO group_messages_legacy_pkey;
+ALTER SEQUENCE group_messages_id_seq OWNED BY NONE;
+
+CREATE TABLE group_messages (
+  id INTEGER NOT NULL DEFAULT nextval('group_messages_id_seq'),
+  group_id INTEGER NOT NULL REFERENCES group_chats(id),
+  sender_id INTEGER NOT NULL REFERENCES users(id),
+  text TEXT NOT NULL DEFAULT '',
+  msg_type VARCHAR(20) NOT NULL DEFAULT 'text',
+  file_url TEXT DEFAULT NULL,
+  file_name TEXT DEFAULT NULL,
+  duration INTEGER DEFAULT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX group_messages_group_id_created_idx ON group_messages(group_id, created_at, id);
+CREATE INDEX group_messages_group_id_id_idx ON group_messages(group_id, id);
+
+SELECT ensure_monthly_partitions('group_messages', 3, (SELECT COALESCE(MIN(created_at), NOW()) FROM group_messages_legacy));
+
+INSERT INTO group_messages (id, group_id, sender_id, text, msg_type, file_url, file_name, duration, created_at)
+SELECT id, group_id, sender_id, text, msg_type, file_url, file_name, duration, COALESCE(created_at, NOW())
+FROM group_messages_legacy;
+
+ALTER SEQUENCE group_messages_id_seq OWNED BY group_messages.id;
+DROP TABLE group_messages_legacy;
+
+-- notifications
+ALTER TABLE notifications RENAME TO notifications_legacy;
+ALTER TABLE notifications_legacy RENAME CONSTRAINT notifications_pkey TO notifications_legacy_pkey;
+ALTER SEQUENCE notifications_id_seq OWNED BY NONE;
+
+CREATE TABLE notifications (
+  id INTEGER NOT NULL DEFAULT nextval('notifications_id_seq'),
+  user_id INTEGER NOT NULL REFERENCES users(id),
+  from_user_id INTEGER REFERENCES users(id),
+  type VARCHAR(30) NOT NULL,
+  post_id INTEGER REFERENCES posts(id),
+  message TEXT DEFAULT '',
+  is_read BOOLEAN DEFAULT FALSE,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX notifications_user_id_created_idx ON notifications(user_id, created_at DESC);
+
+SELECT ensure_monthly_partitions('notifications', 3, (SELECT COALESCE(MIN(created_at), NOW()) FROM notifications_legacy));
+
+INSERT INTO notifications (id, user_id, from_user_id, type, post_id, message, is_read, created_at)
+SELECT id, user_id, from_user_id, type, post_id, message, is_read, COALESCE(created_at, NOW())
+FROM notifications_legacy;
+
+ALTER SEQUENCE notifications_id_seq OWNED BY notifications.id;
+DROP TABLE notifications_legacy;
+
+-- Manifest of per-chat/per-group monthly archives moved to the bucket
+CREATE TABLE IF NOT EXISTS message_archives (
+  kind VARCHAR(10) NOT NULL,
+  owner_id INTEGER NOT NULL,
+  period DATE NOT NULL,
+  s3_key TEXT NOT NULL,
+  row_count INTEGER NOT NULL,
+  PRIMARY KEY (kind, owner_id, period)
+);
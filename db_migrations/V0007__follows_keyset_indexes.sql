@@ -0,0 +1,6 @@
+-- Keyset pagination of following/followers lists, newest first
+UPDATE follows SET created_at = NOW() WHERE created_at IS NULL;
+ALTER TABLE follows ALTER COLUMN created_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS follows_follower_created_idx ON follows(follower_id, created_at, following_id);
+CREATE INDEX IF NOT EXISTS follows_following_created_idx ON follows(following_id, created_at, follower_id);
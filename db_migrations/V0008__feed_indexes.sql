@@ -0,0 +1,5 @@
+-- Feed candidate generation and comment loading
+CREATE INDEX IF NOT EXISTS posts_created_at_idx ON posts(created_at);
+CREATE INDEX IF NOT EXISTS posts_user_id_created_at_idx ON posts(user_id, created_at);
+CREATE INDEX IF NOT EXISTS comments_post_id_idx ON comments(post_id);
+CREATE INDEX IF NOT EXISTS post_hashtags_hashtag_id_idx ON post_hashtags(hashtag_id);
@@ -0,0 +1,25 @@
+-- Client-generated message ids: a retried send finds its original message here.
+-- The message tables are partitioned by created_at, so a unique key on them would have to include it
+CREATE TABLE IF NOT EXISTS message_send_keys (
+  sender_id INTEGER NOT NULL REFERENCES users(id),
+  kind VARCHAR(10) NOT NULL,
+  client_msg_id VARCHAR(64) NOT NULL,
+  message_id INTEGER NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY(sender_id, kind, client_msg_id)
+);
+
+-- Old keys are purged by maintenance once retries can no longer arrive
+CREATE INDEX IF NOT EXISTS message_send_keys_created_idx ON message_send_keys(created_at);
+
+-- Chat summaries, updated in the same transaction as each message
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMPTZ DEFAULT NULL;
+ALTER TABLE group_chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMPTZ DEFAULT NULL;
+
+UPDATE chats c SET last_message_at = m.last_at
+FROM (SELECT chat_id, MAX(created_at) AS last_at FROM chat_messages GROUP BY chat_id) m
+WHERE m.chat_id = c.id;
+
+UPDATE group_chats g SET last_message_at = m.last_at
+FROM (SELECT group_id, MAX(created_at) AS last_at FROM group_messages GROUP BY group_id) m
+WHERE m.group_id = g.id;
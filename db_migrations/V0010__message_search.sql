@@ -0,0 +1,6 @@
+-- In-chat full-text search. Blank texts (deleted messages, media without a caption) are left out of the index;
+-- queries must repeat the same expression and predicate to use it
+CREATE INDEX IF NOT EXISTS chat_messages_text_search_idx ON chat_messages
+  USING GIN (to_tsvector('russian', text)) WHERE text <> '';
+CREATE INDEX IF NOT EXISTS group_messages_text_search_idx ON group_messages
+  USING GIN (to_tsvector('russian', text)) WHERE text <> '';
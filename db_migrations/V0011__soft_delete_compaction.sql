@@ -0,0 +1,32 @@
+-- Tombstones: deleted posts and messages are hidden at once and removed later by maintenance compaction
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ DEFAULT NULL;
+ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ DEFAULT NULL;
+ALTER TABLE group_messages ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ DEFAULT NULL;
+
+-- Earlier deletes only rewrote the text; a blank text message without a file can only be one of them
+UPDATE posts SET deleted_at = NOW() WHERE text = '[удалено]' AND deleted_at IS NULL;
+UPDATE chat_messages SET deleted_at = NOW() WHERE text = '' AND file_url IS NULL AND msg_type = 'text' AND deleted_at IS NULL;
+
+-- Feed, profile and counts read only live posts, so their indexes leave tombstones out
+DROP INDEX IF EXISTS posts_created_at_idx;
+DROP INDEX IF EXISTS posts_user_id_created_at_idx;
+CREATE INDEX IF NOT EXISTS posts_live_created_at_idx ON posts(created_at) WHERE deleted_at IS NULL;
+CREATE INDEX IF NOT EXISTS posts_live_user_id_created_at_idx ON posts(user_id, created_at) WHERE deleted_at IS NULL;
+
+-- Compaction queue, oldest tombstone first
+CREATE INDEX IF NOT EXISTS posts_deleted_at_idx ON posts(deleted_at) WHERE deleted_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS chat_messages_deleted_at_idx ON chat_messages(deleted_at) WHERE deleted_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS group_messages_deleted_at_idx ON group_messages(deleted_at) WHERE deleted_at IS NOT NULL;
+
+-- Dependents removed with a compacted post
+CREATE INDEX IF NOT EXISTS notifications_post_id_idx ON notifications(post_id) WHERE post_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS post_likes_post_id_idx ON post_likes(post_id);
+CREATE INDEX IF NOT EXISTS comment_likes_comment_id_idx ON comment_likes(comment_id);
+
+-- Bucket reconciliation looks up each listed object by its key, the part of the CDN URL after /bucket/
+CREATE INDEX IF NOT EXISTS posts_media_key_idx ON posts(split_part(media_url, '/bucket/', 2))
+  WHERE media_url IS NOT NULL;
+CREATE INDEX IF NOT EXISTS chat_messages_file_key_idx ON chat_messages(split_part(file_url, '/bucket/', 2))
+  WHERE file_url IS NOT NULL;
+CREATE INDEX IF NOT EXISTS group_messages_file_key_idx ON group_messages(split_part(file_url, '/bucket/', 2))
+  WHERE file_url IS NOT NULL;
@@ -0,0 +1,69 @@
+-- Safety net for the monthly partitions: nothing guarantees maintenance runs before the last
+-- partition is passed, and without a DEFAULT partition every insert would then fail. Rows that
+-- land here are moved into their month's partition as soon as ensure_monthly_partitions creates it.
+-- The DEFAULT partition costs ordered partition scans (the planner uses a merge instead), which the
+-- per-chat index scans with LIMIT tolerate.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent REGCLASS, months_ahead INTEGER DEFAULT 3, since TIMESTAMPTZ DEFAULT NOW())
+RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+  nsp TEXT;
+  rel TEXT;
+  part TEXT;
+  fallback TEXT;
+  stray_months TEXT := 'SELECT NULL::timestamp WHERE FALSE';
+  has_rows BOOLEAN;
+  month_start TIMESTAMP;
+  last_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC') + make_interval(months => months_ahead);
+  created INTEGER := 0;
+BEGIN
+  SELECT n.nspname, c.relname INTO nsp, rel
+  FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+  WHERE c.oid = parent;
+  fallback := rel || '_default';
+
+  -- The months ahead, plus every month with rows waiting in the DEFAULT partition
+  IF to_regclass(format('%I.%I', nsp, fallback)) IS NOT NULL THEN
+    stray_months := format('SELECT DISTINCT date_trunc(''month'', created_at AT TIME ZONE ''UTC'') FROM %I.%I',
+                           nsp, fallback);
+  END IF;
+
+  FOR month_start IN EXECUTE format(
+      'SELECT generate_series(%L::timestamp, %L::timestamp, INTERVAL ''1 month'') UNION %s ORDER BY 1',
+      date_trunc('month', since AT TIME ZONE 'UTC'), last_month, stray_months) LOOP
+    part := format('%s_p%s', rel, to_char(month_start, 'YYYY_MM'));
+    IF to_regclass(format('%I.%I', nsp, part)) IS NULL THEN
+      has_rows := FALSE;
+      IF to_regclass(format('%I.%I', nsp, fallback)) IS NOT NULL THEN
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I.%I WHERE created_at >= %L AND created_at < %L)',
+                       nsp, fallback,
+                       month_start AT TIME ZONE 'UTC',
+                       (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC') INTO has_rows;
+      END IF;
+      IF has_rows THEN
+        -- A partition cannot be created over rows still in the DEFAULT one: build it aside, move them, attach
+        EXECUTE format('CREATE TABLE %I.%I (LIKE %I.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', nsp, part, nsp, rel);
+        EXECUTE format('WITH moved AS (DELETE FROM %I.%I WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                       'INSERT INTO %I.%I SELECT * FROM moved',
+                       nsp, fallback,
+                       month_start AT TIME ZONE 'UTC',
+                       (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC',
+                       nsp, part);
+        EXECUTE format('ALTER TABLE %I.%I ATTACH PARTITION %I.%I FOR VALUES FROM (%L) TO (%L)',
+                       nsp, rel, nsp, part,
+                       month_start AT TIME ZONE 'UTC',
+                       (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC');
+      ELSE
+        EXECUTE format('CREATE TABLE %I.%I PARTITION OF %I.%I FOR VALUES FROM (%L) TO (%L)',
+                       nsp, part, nsp, rel,
+                       month_start AT TIME ZONE 'UTC',
+                       (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC');
+      END IF;
+      created := created + 1;
+    END IF;
+  END LOOP;
+  RETURN created;
+END $$;
+
+CREATE TABLE IF NOT EXISTS chat_messages_default PARTITION OF chat_messages DEFAULT;
+CREATE TABLE IF NOT EXISTS group_messages_default PARTITION OF group_messages DEFAULT;
+CREATE TABLE IF NOT EXISTS notifications_default PARTITION OF notifications DEFAULT;
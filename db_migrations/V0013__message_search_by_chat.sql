@@ -0,0 +1,13 @@
+-- Search within one chat or group: with the text alone indexed, the planner either collected every chat's
+-- matches and filtered them by owner, or walked the owner's messages and computed to_tsvector for each.
+-- btree_gin puts the owner id in the same GIN index, so both conditions are answered by one scan. Searches
+-- across all of a user's chats can run it once per chat through the semi-join on their membership.
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE INDEX IF NOT EXISTS chat_messages_chat_text_search_idx ON chat_messages
+  USING GIN (chat_id, to_tsvector('russian', text)) WHERE text <> '';
+CREATE INDEX IF NOT EXISTS group_messages_group_text_search_idx ON group_messages
+  USING GIN (group_id, to_tsvector('russian', text)) WHERE text <> '';
+
+DROP INDEX IF EXISTS chat_messages_text_search_idx;
+DROP INDEX IF EXISTS group_messages_text_search_idx;